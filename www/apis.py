@@ -7,6 +7,8 @@ JSON API definition.
 
 
 import json
+import base64
+import binascii
 import logging
 import inspect
 import functools
@@ -67,9 +69,31 @@ class Page(object):
             self.limit = self.page_size
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
+        # keyset分页的游标，指向本页最后一条记录，由handler填写
+        self.next_cursor = None
 
     def __str__(self):
         return 'item_count :%s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % \
             (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
     
     __repr__ = __str__
+
+
+def encode_cursor(created_at, id):
+    '''
+    Build an opaque keyset pagination token from the (created_at, id) of the last row on a page.
+    '''
+    s = json.dumps([created_at, id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    '''
+    Parse a token from encode_cursor() back into (created_at, id).
+    '''
+    try:
+        s = base64.urlsafe_b64decode((token + '=' * (-len(token) % 4)).encode('ascii')).decode('utf-8')
+        created_at, id = json.loads(s)
+        return float(created_at), str(id)
+    except (ValueError, TypeError, binascii.Error):
+        raise APIValueError('cursor', 'invalid cursor.')
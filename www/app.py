@@ -6,8 +6,11 @@ async web application.
 '''
 
 import asyncio
-import json
 import orm
+import serialize
+import tracing
+import random
+from metrics import REGISTRY
 import logging
 logging.basicConfig(level=logging.INFO)
 import os
@@ -49,6 +52,56 @@ def init_jinja2(app, **kw):
     app['__templating__'] = env
 
 
+# 按路由模板(__route__)统计请求数、状态码类别和延迟直方图，静态文件和404记为<other>
+_requests = REGISTRY.counter('http_requests_total', 'HTTP requests by route, method and status class.',
+                             ('route', 'method', 'status'))
+_latency = REGISTRY.histogram('http_request_duration_seconds', 'HTTP request latency by route and method.',
+                              ('route', 'method'))
+
+
+async def metrics_factory(app, handler):
+    async def metrics(request):
+        start = time.perf_counter()
+        status = 500
+        try:
+            r = await handler(request)
+            status = r.status
+            return r
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            route = getattr(request.match_info.handler, '__route__', None) or '<other>'
+            _latency.labels(route, request.method).observe(time.perf_counter() - start)
+            _requests.labels(route, request.method, '%dxx' % (status // 100)).inc()
+    return metrics
+
+
+# 按configs.tracing.sample的比例抽样请求，记录从中间件到SQL、markdown、模板渲染的span，
+# 请求结束后写到configs.tracing.dir下的Chrome trace JSON文件
+async def tracing_factory(app, handler):
+    sample = configs.tracing.sample
+    trace_dir = configs.tracing.dir
+    if sample:
+        os.makedirs(trace_dir, exist_ok=True)
+
+    async def traced(request):
+        if not sample or random.random() >= sample:
+            return (await handler(request))
+        trace, token = tracing.start('%s %s' % (request.method, request.path))
+        try:
+            with tracing.span('request', method=request.method, path=request.path_qs) as s:
+                r = await handler(request)
+                s.args['route'] = getattr(request.match_info.handler, '__route__', None)
+                s.args['status'] = r.status
+                return r
+        finally:
+            tracing.finish(token)
+            path = os.path.join(trace_dir, 'trace-%d-%d.json' % (int(time.time() * 1000), trace.id))
+            await asyncio.get_event_loop().run_in_executor(None, trace.dump, path)
+    return traced
+
+
 async def logger_factory(app, handler):
     async def logger(request):
         # 记录日志
@@ -62,6 +115,15 @@ async def data_factory(app, handler):
     pass
 
 
+async def orm_factory(app, handler):
+    async def orm_scope(request):
+        # 每个请求一个Loader，合并并缓存本次请求里的Model.find();
+        # 本次请求写过数据库之后，后续读取都走主库
+        with orm.request_scope():
+            return (await handler(request))
+    return orm_scope
+
+
 async def auth_factory(app, handler):
     async def auth(request):
         logging.info('check user: %s %s' % (request.method, request.path))
@@ -80,12 +142,60 @@ async def auth_factory(app, handler):
 # response这个middleware把返回值转换为web.Response对象再返回，以保证满足aiohttp的要求
 
 
+# handler返回异步迭代器(例如Model.iterate())时，边读边以chunked编码发送JSON数组，
+# 请求Accept: application/x-ndjson或带format=ndjson时每行一个JSON对象;
+# 响应头和开头的'['立即发出，之后每攒够_STREAM_CHUNK字节写一次，内存占用与总行数无关
+_STREAM_CHUNK = 16384
+
+
+async def stream_response(request, items):
+    ndjson = 'application/x-ndjson' in request.headers.get('Accept', '') or request.query.get('format') == 'ndjson'
+    resp = web.StreamResponse()
+    resp.content_type = 'application/x-ndjson' if ndjson else 'application/json'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    sep = b'\n' if ndjson else b','
+    buf, size = [] if ndjson else [b'['], 0
+    first = True
+    try:
+        async for item in items:
+            data = serialize.dumps(item)
+            if ndjson:
+                buf.append(data)
+                buf.append(sep)
+            else:
+                if not first:
+                    buf.append(sep)
+                buf.append(data)
+            first = False
+            size += len(data) + 1
+            if size >= _STREAM_CHUNK:
+                await resp.write(b''.join(buf))
+                buf, size = [], 0
+    except Exception:
+        # 状态码已经发出，只能中断连接，客户端会收到不完整的JSON
+        logging.exception('stream %s aborted' % request.path)
+        raise
+    finally:
+        aclose = getattr(items, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+    if not ndjson:
+        buf.append(b']')
+    await resp.write(b''.join(buf))
+    await resp.write_eof()
+    return resp
+
+
 async def response_factory(app, handler):
     async def response(request):
         # 处理结果
         r = await handler(request)
         if isinstance(r, web.StreamResponse):
             return r
+        if hasattr(r, '__aiter__'):
+            return await stream_response(request, r)
         if isinstance(r, bytes):
             resp = web.Response(body=r)
             resp.content_type = 'application/octet-stream'
@@ -99,14 +209,14 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(
-                    body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=serialize.dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
                 r['__user__'] = request.__user__
-                resp = web.Response(
-                    body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                with tracing.span('render', template=template):
+                    body = app['__templating__'].get_template(template).render(**r).encode('utf-8')
+                resp = web.Response(body=body)
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
         if isinstance(r, int) and r >= 100 and r < 600:
@@ -138,7 +248,8 @@ def datetime_filter(t):
 
 async def init(loop):
     await orm.create_pool(loop=loop, **configs.db)
-    app = web.Application(loop=loop, middlewares=(logger_factory, auth_factory, response_factory))
+    serialize.use(configs.json.backend)
+    app = web.Application(loop=loop, middlewares=(metrics_factory, tracing_factory, logger_factory, orm_factory, auth_factory, response_factory))
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     add_routes(app, 'handlers')
     add_static(app)
@@ -0,0 +1,313 @@
+#!/bin/bash env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks against the database in configs.db.
+
+Usage: python3 bench.py save_many|sql|rows|args|ids|upsert|handler|json|metrics [n]
+
+Benchmarks listed in OFFLINE only measure Python overhead and need no database.
+'''
+
+import asyncio
+import logging
+import sys
+import time
+import tracemalloc
+import orm
+import coroweb
+import json
+import serialize
+from apis import Page
+from metrics import Registry
+from urllib import parse
+from config import configs
+from models import User, Blog, Comment, next_id, legacy_id
+
+# orm等模块import时已经把日志设为INFO，跑benchmark时关掉SQL日志
+logging.getLogger().setLevel(logging.WARNING)
+
+BENCH_BLOG_ID = 'bench'
+
+
+def report(name, n, seconds):
+    print('%-28s %8d ops %10.3f s %12.1f ops/s' % (name, n, seconds, n / seconds if seconds else 0))
+
+
+def make_comments(n):
+    return [Comment(blog_id=BENCH_BLOG_ID, user_id='bench', user_name='bench', user_image='about:blank',
+                    content='comment %s' % i) for i in range(n)]
+
+
+async def cleanup():
+    await orm.execute('delete from `comments` where `blog_id`=?', [BENCH_BLOG_ID])
+
+
+async def bench_save_many(n=1000):
+    await cleanup()
+    comments = make_comments(n)
+    start = time.perf_counter()
+    for c in comments:
+        await c.save()
+    report('save() loop', n, time.perf_counter() - start)
+    await cleanup()
+    comments = make_comments(n)
+    start = time.perf_counter()
+    await Comment.save_many(comments)
+    report('save_many()', n, time.perf_counter() - start)
+    await cleanup()
+
+
+def legacy_find_all_sql(cls, where, args, orderBy, limit):
+    # 语句缓存之前findAll()/select()每次查询都要做的事: 拼SQL、替换占位符、格式化日志
+    sql = [cls.__select__]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    args = list(args)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    sql.append('limit')
+    sql.append('?, ?')
+    args.extend(limit)
+    sql = ' '.join(sql)
+    'SQL: %s (Args: %s)' % (sql, args)
+    return sql.replace('?', '%s'), args
+
+
+async def bench_sql(n=100000):
+    start = time.perf_counter()
+    for i in range(n):
+        legacy_find_all_sql(Blog, 'user_id=?', ['x'], 'created_at desc', (0, 5))
+    report('sql build (before)', n, time.perf_counter() - start)
+    start = time.perf_counter()
+    for i in range(n):
+        sql, args, unloaded = Blog._findAllSql('user_id=?', ['x'], orderBy='created_at desc', limit=(0, 5))
+        orm.statement(sql)
+    report('sql build (cached)', n, time.perf_counter() - start)
+
+
+def comment_tuples(n):
+    return [('%050d' % i, 'blog', 'user', 'name', 'about:blank', 'comment %s' % i, 1500000000.0 + i) for i in range(n)]
+
+
+async def bench_rows(n=10000):
+    # 比较Comment对象和Comment.__row__对象的构造时间和内存，不访问数据库
+    tuples = comment_tuples(n)
+    columns = (Comment.__primary_key__,) + tuple(Comment.__fields__)
+    tracemalloc.start()
+    start = time.perf_counter()
+    models = [Comment._loaded(dict(zip(columns, t))) for t in tuples]
+    seconds = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    report('Model rows', n, seconds)
+    print('%-28s %8.1f KB' % ('  memory', size / 1024))
+    del models
+    make = orm._row_maker(Comment.__row__, columns)
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = [make(t) for t in tuples]
+    seconds = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    report('Row objects', n, seconds)
+    print('%-28s %8.1f KB' % ('  memory', size / 1024))
+
+
+async def bench_args(n=100000):
+    # save()每行构造参数的开销: 逐字段getValueOrDefault()与生成的__insert_args__
+    samples = [
+        User(email='test@example.com', passwd='0' * 40, admin=False, name='test', image='about:blank'),
+        Blog(user_id='u', user_name='test', user_image='about:blank', name='blog', summary='summary', content='content'),
+        Comment(blog_id='b', user_id='u', user_name='test', user_image='about:blank', content='comment'),
+    ]
+    for obj in samples:
+        name = obj.__class__.__name__
+        start = time.perf_counter()
+        for i in range(n):
+            args = list(map(obj.getValueOrDefault, obj.__fields__))
+            args.append(obj.getValueOrDefault(obj.__primary_key__))
+        report('%s getValueOrDefault' % name, n, time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(n):
+            obj.__insert_args__(obj)
+        report('%s __insert_args__' % name, n, time.perf_counter() - start)
+
+
+async def bench_ids(n=20000):
+    # 插入吞吐量: 旧的时间戳+uuid主键与按时间递增的主键
+    for name, make_id in (('legacy_id()', legacy_id), ('next_id()', next_id)):
+        await cleanup()
+        comments = make_comments(n)
+        for c in comments:
+            c.id = make_id()
+        start = time.perf_counter()
+        await Comment.save_many(comments, chunk=100)
+        report('insert %s' % name, n, time.perf_counter() - start)
+    await cleanup()
+
+
+async def bench_upsert(n=1000):
+    # 一半已存在一半新插入: find()再save()/update()，与upsert()和upsert_many()比较
+    for name in ('find + save/update', 'upsert()', 'upsert_many()'):
+        await cleanup()
+        # 主键预先分配: 已存在的行按id冲突，新行也带id，find + save/update对每行都先按id查找
+        existing = make_comments(n // 2)
+        for c in existing:
+            c.id = next_id()
+        await Comment.save_many(existing)
+        comments = [Comment(id=c.id, blog_id=BENCH_BLOG_ID, user_id='bench', user_name='bench',
+                            user_image='about:blank', content='updated') for c in existing]
+        for c in make_comments(n - len(comments)):
+            c.id = next_id()
+            comments.append(c)
+        start = time.perf_counter()
+        if name == 'upsert_many()':
+            await Comment.upsert_many(comments, update=['content'])
+        elif name == 'upsert()':
+            for c in comments:
+                await c.upsert(update=['content'])
+        else:
+            for c in comments:
+                found = await Comment.find(c.id)
+                if found is None:
+                    await c.save()
+                else:
+                    found.content = c.content
+                    await found.update()
+        report(name, n, time.perf_counter() - start)
+    await cleanup()
+
+
+def legacy_handler_flags(fn):
+    return dict(request=coroweb.has_request_arg(fn), var_kw=coroweb.has_var_kw_arg(fn),
+                has_named=coroweb.has_named_kw_args(fn), named=coroweb.get_named_kw_args(fn),
+                required=coroweb.get_required_kw_args(fn))
+
+
+def legacy_handler_kw(flags, request):
+    # 参数绑定计划之前RequestHandler.__call__()每个请求都要做的事(GET部分)
+    kw = None
+    if flags['var_kw'] or flags['has_named'] or flags['required']:
+        if request.method == 'GET':
+            qs = request.query_string
+            if qs:
+                kw = dict()
+                for k, v in parse.parse_qs(qs, True).items():
+                    kw[k] = v[0]
+    if kw is None:
+        kw = dict(**request.match_info)
+    else:
+        if not flags['var_kw'] and flags['named']:
+            copy = dict()
+            for name in flags['named']:
+                if name in kw:
+                    copy[name] = kw[name]
+            kw = copy
+        for k, v in request.match_info.items():
+            kw[k] = v
+    if flags['request']:
+        kw['request'] = request
+    for name in flags['required']:
+        if not name in kw:
+            raise ValueError(name)
+    logging.info('call with args: %s' % str(kw))
+    return kw
+
+
+async def bench_handler(n=100000):
+    from aiohttp.test_utils import make_mocked_request
+
+    async def handler(id, request, *, page='1', cursor=None):
+        pass
+
+    request = make_mocked_request('GET', '/blog/x?page=2&cursor=abc&utm_source=bench', match_info={'id': 'x'})
+    flags = legacy_handler_flags(handler)
+    start = time.perf_counter()
+    for _ in range(n):
+        legacy_handler_kw(flags, request)
+    report('legacy RequestHandler', n, time.perf_counter() - start)
+    bind = coroweb.make_binder(handler)
+    start = time.perf_counter()
+    for _ in range(n):
+        await bind(request)
+    report('compiled binder', n, time.perf_counter() - start)
+
+
+def legacy_json_default(o):
+    if isinstance(o, orm.Row):
+        return o.to_dict()
+    return o.__dict__
+
+
+async def bench_json(n=1000, repeat=100):
+    # n行的列表响应，分别用Model对象和findRows()的Row对象，各编码repeat次
+    blogs = [Blog(id=next_id(), user_id='bench', user_name='bench', user_image='about:blank', name='blog %s' % i,
+                  summary='summary of blog %s' % i, content='content of blog %s' % i, created_at=time.time())
+             for i in range(n)]
+    make = orm._row_maker(Blog.__row__, Blog.__row__.__slots__)
+    payloads = [('models', blogs), ('rows', [make(tuple(b[c] for c in Blog.__row__.__slots__)) for b in blogs])]
+    for kind, items in payloads:
+        r = dict(page=Page(n), blogs=items)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            json.dumps(r, ensure_ascii=False, default=legacy_json_default).encode('utf-8')
+        report('json.dumps %s' % kind, n * repeat, time.perf_counter() - start)
+        for name in sorted(serialize._BACKENDS):
+            serialize.use(name)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                serialize.dumps(r)
+            report('serialize %s %s' % (name, kind), n * repeat, time.perf_counter() - start)
+    serialize.use()
+
+
+async def bench_metrics(n=100000):
+    # metrics中间件每个请求的记录开销: 两次labels()查找、一次observe()、一次inc()
+    registry = Registry()
+    requests = registry.counter('requests', 'bench', ('route', 'method', 'status'))
+    latency = registry.histogram('latency', 'bench', ('route', 'method'))
+    routes = ['/api/blogs', '/api/blogs/{id}', '/blog/{id}', '/']
+    start = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        route = routes[i & 3]
+        latency.labels(route, 'GET').observe(time.perf_counter() - t)
+        requests.labels(route, 'GET', '2xx').inc()
+    report('record request', n, time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(100):
+        registry.render()
+    report('render', 100, time.perf_counter() - start)
+
+
+BENCHES = {
+    'save_many': bench_save_many,
+    'sql': bench_sql,
+    'rows': bench_rows,
+    'args': bench_args,
+    'ids': bench_ids,
+    'upsert': bench_upsert,
+    'handler': bench_handler,
+    'json': bench_json,
+    'metrics': bench_metrics,
+}
+
+OFFLINE = {'sql', 'rows', 'args', 'handler', 'json', 'metrics'}
+
+
+async def main(loop, name, args):
+    if name not in OFFLINE:
+        await orm.create_pool(loop=loop, **configs.db)
+    await BENCHES[name](*args)
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in BENCHES:
+        print('Usage: python3 bench.py %s [n]' % '|'.join(sorted(BENCHES)))
+        exit(0)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, argv[0], [int(a) for a in argv[1:]]))
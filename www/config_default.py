@@ -13,9 +13,44 @@ configs = {
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'database': 'awesome'
+        'database': 'awesome',
+        # 合并并发的相同SELECT
+        'coalesce': False,
+        # 只读副本，每项可以覆盖host、port、user等，未写的沿用主库配置，例如:
+        # [{'host': '127.0.0.1', 'port': 3307}]
+        'replicas': [],
+        # 'round_robin'或'least_loaded'
+        'replica_policy': 'round_robin',
+        # 等待连接超过这个秒数时打印警告
+        'wait_warning': 0.1,
+        # 启动时预先建立的连接数
+        'warmup': 5,
+        # 每隔多少秒ping一次空闲连接，0表示不检查
+        'keepalive': 30,
+        # 根据等待情况自动调整maxsize，例如{'min': 5, 'max': 30, 'interval': 10, 'step': 2}，None表示不调整
+        'autoscale': None
     },
     'session': {
         'secret': 'AwEsOmE'
+    },
+    'metrics': {
+        # Prometheus文本格式的指标页面
+        'path': '/metrics',
+        # 允许访问的客户端地址，空列表表示不限制
+        'allow': ['127.0.0.1']
+    },
+    'tracing': {
+        # 记录span的请求比例，0表示关闭，1表示每个请求都记录
+        'sample': 0.0,
+        # trace文件目录，用chrome://tracing或Perfetto打开
+        'dir': 'traces'
+    },
+    'json': {
+        # 'orjson'、'stdlib'或'auto'(安装了orjson就用orjson)
+        'backend': 'auto'
+    },
+    'ids': {
+        # 生成主键用的worker id(0-9999)，同时运行的每个进程必须不同
+        'worker': 0
     }
 }
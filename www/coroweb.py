@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 from aiohttp import web
-from urllib import parse
 from apis import APIError
 import functools
 import asyncio
@@ -102,64 +101,124 @@ def has_request_arg(fn):
 # 然后把结果转换为web.Response对象，这样，就完全符合aiohttp框架的要求
 
 
+# 参数绑定计划: add_route时分析一次函数签名，生成专门的bind(request)函数，
+# 请求时直接从match_info、query或body里取出需要的参数，不再逐个判断标志位、复制字典;
+# 带int/float/bool注解的参数会做类型转换，转换失败返回400
+
+_MISSING = object()
+
+
+def _coerce_bool(v):
+    if isinstance(v, bool):
+        return v
+    v = str(v).lower()
+    if v in ('1', 'true', 'yes', 'on'):
+        return True
+    if v in ('0', 'false', 'no', 'off', ''):
+        return False
+    raise ValueError(v)
+
+
+_COERCIONS = {int: int, float: float, bool: _coerce_bool}
+
+
+def _coerce(name, fn, v):
+    try:
+        return fn(v)
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(text='Invalid argument: %s' % name)
+
+
+async def _read_params(request):
+    # GET取query，POST按Content-Type取JSON或表单，其他方法没有参数
+    method = request.method
+    if method == 'GET':
+        return request.query
+    if method == 'POST':
+        if not request.content_type:
+            raise web.HTTPBadRequest(text='Missing Content-Type.')
+        ct = request.content_type.lower()
+        if ct.startswith('application/json'):
+            params = await request.json()
+            if not isinstance(params, dict):
+                raise web.HTTPBadRequest(text='JSON body must be object.')
+            return params
+        if ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+            return await request.post()
+        raise web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+    return None
+
+
+def _warn_duplicate(name):
+    logging.warn('Duplicate arg name in named arg and kw args: %s' % name)
+
+
+def make_binder(fn):
+    '''
+    Compile the signature of fn into bind(request) returning the call kwargs.
+    '''
+    named = get_named_kw_args(fn)
+    var_kw = has_var_kw_arg(fn)
+    params = inspect.signature(fn).parameters
+    lines = ['async def bind(request):', '    kw = {}']
+    if var_kw or named:
+        lines.append('    params = await _read_params(request)')
+        lines.append('    if params is not None:')
+        if var_kw:
+            # **kw: body/query里的参数全部传入，同名的取第一个
+            lines.append('        for k, v in params.items():')
+            lines.append('            if k not in kw:')
+            lines.append('                kw[k] = v')
+        else:
+            for name in named:
+                lines.append('        v = params.get(%r, _MISSING)' % name)
+                lines.append('        if v is not _MISSING:')
+                lines.append('            kw[%r] = v' % name)
+        lines.append('        for k, v in request.match_info.items():')
+        lines.append('            if k in kw:')
+        lines.append('                _warn_duplicate(k)')
+        lines.append('            kw[k] = v')
+        lines.append('    else:')
+        lines.append('        kw.update(request.match_info)')
+    else:
+        lines.append('    kw.update(request.match_info)')
+    for name, param in params.items():
+        coerce = _COERCIONS.get(param.annotation)
+        if coerce is not None:
+            lines.append('    v = kw.get(%r, _MISSING)' % name)
+            lines.append('    if v is not _MISSING:')
+            lines.append('        kw[%r] = _coerce(%r, _coerce_%s, v)' % (name, name, name))
+    if has_request_arg(fn):
+        lines.append("    kw['request'] = request")
+    for name in get_required_kw_args(fn):
+        lines.append('    if %r not in kw:' % name)
+        lines.append("        raise web.HTTPBadRequest(text='Missing argument: %s')" % name)
+    lines.append('    return kw')
+    namespace = dict(_MISSING=_MISSING, _read_params=_read_params, _warn_duplicate=_warn_duplicate,
+                     _coerce=_coerce, web=web)
+    for name, param in params.items():
+        if param.annotation in _COERCIONS:
+            namespace['_coerce_%s' % name] = _COERCIONS[param.annotation]
+    exec('\n'.join(lines), namespace)
+    return namespace['bind']
+
+
 class RequestHandler(object):
 
     def __init__(self, app, fn):
         self.__app = app
         self.__func = fn
-        self.__has_request_arg = has_request_arg(fn)
-        self.__has_var_kw_arg = has_var_kw_arg(fn)
-        self.__has_named_kw_args = has_named_kw_args(fn)
-        self.__named_kw_args = get_named_kw_args(fn)
-        self.__required_kw_args = get_required_kw_args(fn)
+        self.__bind = make_binder(fn)
+        # 路由模板，metrics按它而不是实际路径统计
+        self.__route__ = getattr(fn, '__route__', None)
 
     async def __call__(self, request):
-        kw = None
-        # 获取参数
-        if self.__has_var_kw_arg or self.__has_named_kw_args or self.__required_kw_args:
-            if request.method == 'POST':
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type.')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            kw = dict(**request.match_info)
-        else:
-            if not self.__has_var_kw_arg and self.__named_kw_args:
-                # remove all unnamed kw
-                copy = dict()
-                for name in self.__named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named arg
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warn('Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        if self.__has_request_arg:
-            kw['request'] = request
-        # check required kw
-        if self.__required_kw_args:
-            for name in self.__required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+        try:
+            kw = await self.__bind(request)
+        except web.HTTPBadRequest as e:
+            return e
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('call %s with args: %s' % (self.__func.__name__, kw))
         try:
             r = await self.__func(**kw)
             return r
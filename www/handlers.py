@@ -4,12 +4,15 @@
 from coroweb import get, post
 from aiohttp import web
 from models import User, Blog, Comment, next_id
-from apis import APIError, APIPermissionError, APIResourceNotFoundError, APIValueError, Page
+from apis import APIError, APIPermissionError, APIResourceNotFoundError, APIValueError, Page, encode_cursor, decode_cursor
 from aiohttp import web
 from config import configs
+from orm import transaction, is_duplicate
+from metrics import REGISTRY
+from tracing import span
 import markdown2
 import time
-import json
+import serialize
 import hashlib
 import re
 import logging
@@ -84,12 +87,34 @@ def get_page_index(page_str):
     return p
 
 
+# 列表统一按(created_at, id)倒序，offset分页和keyset分页的结果才能衔接
+_ORDER_BY_LATEST = 'created_at desc, id desc'
+
+
+async def find_page(model, p, cursor=None, compact=False, **kw):
+    '''
+    Load one page of rows, seeking past cursor if given, else by offset. Sets p.next_cursor.
+    With compact=True the page holds read-only orm.Row objects instead of models.
+    '''
+    find = model.findRows if compact else model.findAll
+    if cursor:
+        rows = await find(orderBy=_ORDER_BY_LATEST, limit=p.page_size + 1, after=decode_cursor(cursor), **kw)
+        has_next = len(rows) > p.page_size
+        rows = rows[:p.page_size]
+    else:
+        rows = await find(orderBy=_ORDER_BY_LATEST, limit=(p.offset, p.limit), **kw)
+        has_next = p.has_next
+    if has_next and rows:
+        p.next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    return rows
+
+
 @get('/')
-async def handler_url_index(request, *, page='1'):
+async def handler_url_index(request, *, page='1', cursor=None):
     page_index = get_page_index(page)
     blogs_count = await Blog.findNumber('id')
     p = Page(blogs_count, page_index, page_size=5)
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await find_page(Blog, p, cursor, prefetch=['comment_count'])
     return {
         '__template__': 'blogs.html',
         'blogs': blogs,
@@ -160,19 +185,26 @@ async def handler_api_users(*, page='1'):
     num = await User.findNumber('id')
     p = Page(num, page_index)
     if num == 0:
-        return dict(users=())
-    users = await User.findAll(orderBy='created_at desc')
+        return dict(page=p, users=())
+    users = await find_page(User, p, compact=True)
     return dict(page=p, users=users)
 
 
+# 导出全部用户: 返回异步迭代器，由response_factory边读边发送(JSON数组或NDJSON)
+@get('/api/users/export')
+async def handler_api_users_export(request):
+    check_admin(request)
+    return User.iterate(orderBy=_ORDER_BY_LATEST, batch=200)
+
+
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', cursor=None):
     page_index = get_page_index(page)
     num = await Blog.findNumber('id')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await find_page(Blog, p, cursor, compact=True)
     return dict(page=p, blogs=blogs)
 
 
@@ -216,7 +248,10 @@ async def handler_post_api_blogs_by_blog_id(id, request, *, name, summary, conte
 async def handler_api_delete_by_blog_id(request, *, blog_id):
     check_admin(request)
     blog = await Blog.find(blog_id)
-    await blog.remove()
+    # 博客和它的评论在同一个事务里删除
+    async with transaction():
+        await blog.remove()
+        await Comment.removeAll('`blog_id`=?', [blog_id])
     return blog
 
 
@@ -231,11 +266,11 @@ async def handler_post_api_comments_by_blog_id(blog_id, request, *, content):
 
 
 @get('/api/comments')
-async def handler_api_get_comments(request, *, page='1'):
+async def handler_api_get_comments(request, *, page='1', cursor=None):
     page_index = get_page_index(page)
     comments_count = await Comment.findNumber('id')
     p = Page(comments_count, page_index)
-    comments = await Comment.findAll(limit=(p.offset, p.limit))
+    comments = await find_page(Comment, p, cursor, compact=True)
     return dict(comments=comments, page=p)
 
 
@@ -255,22 +290,27 @@ async def handeler_post_api_users(request, *, email, name, passwd):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIError('passwd')
-    users = await User.findAll(where='email=?', args=[email])
-    if len(users) > 0:
-        raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
     sha1_passwd = '%s:%s' % (uid, passwd)
     user = User(id=uid, name=name.strip(), email=email,
                 passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(),
                 image='http://www.gravatar.com/avatar/%s?d=mm&s=120'
                 % hashlib.md5(email.encode('utf-8')).hexdigest())
-    await user.save()
+    users = await User.findAll(where='email=?', args=[email])
+    if len(users) > 0:
+        raise APIError('register:failed', 'email', 'Email is already in use.')
+    # 并发注册可能同时通过上面的检查，由email的唯一索引拒绝后插入的一个
+    try:
+        await user.save()
+    except Exception as e:
+        if is_duplicate(e):
+            raise APIError('register:failed', 'email', 'Email is already in use.')
+        raise
     # make session cookie
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
-    user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serialize.dumps(user)
     return r
 
 
@@ -297,12 +337,21 @@ async def handler_post_api_authenticate(request, *, email, passwd):
     # authenticate ok, set cookie
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
-    user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = serialize.dumps(user)
     return r
 
 
+# Prometheus抓取的指标页面，路径和允许的地址在configs.metrics里配置
+@get(configs.metrics.path)
+async def handler_metrics(request):
+    allow = configs.metrics.allow
+    if allow and request.remote not in allow:
+        return web.HTTPForbidden()
+    return web.Response(body=REGISTRY.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
 # Browser
 @get('/register')
 async def handler_url_register(request):
@@ -338,10 +387,14 @@ async def handler_url_blog(request):
 @get('/blog/{id}')
 async def handler_url_blogid(request, *, id):
     blog = await Blog.find(id)
-    comments = await Comment.findAll(where='blog_id=?', args=[id], orderBy='created_at desc')
-    for c in comments:
-        c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    if blog is None:
+        raise APIResourceNotFoundError('blog')
+    await Blog.prefetch([blog], ['comments'])
+    comments = blog.comments
+    with span('markdown', comments=len(comments)):
+        for c in comments:
+            c.html_content = text2html(c.content)
+        blog.html_content = markdown2.markdown(blog.content)
     return {
         '__template__': 'blog.html',
         'blog': blog,
@@ -0,0 +1,166 @@
+#!/bin/bash env python3
+# -*- coding: utf-8 -*-
+
+'''
+Lightweight in-process metrics.
+'''
+
+import bisect
+
+
+class Histogram(object):
+    '''
+    Histogram of observed values (seconds) with fixed bucket upper bounds, Prometheus style.
+    '''
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        # 最后一个桶是+Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        '''
+        Estimate the q-quantile by linear interpolation inside the bucket that contains it.
+        '''
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def summary(self):
+        return dict(count=self.count, sum=self.sum,
+                    p50=self.quantile(0.5), p95=self.quantile(0.95), p99=self.quantile(0.99))
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Family(object):
+    '''
+    A named metric with one child (Counter or Histogram) per tuple of label values.
+    '''
+
+    def __init__(self, name, help, kind, labelnames, factory):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.children = dict()
+        self._factory = factory
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s expects labels %s' % (self.name, self.labelnames))
+            child = self.children[values] = self._factory()
+        return child
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+# 进程内的指标注册表: 请求计数和延迟、ORM查询耗时、连接池状态都登记在REGISTRY里，
+# render()输出Prometheus文本格式; 直方图额外输出p50/p95/p99估计值，方便不用Prometheus时直接查看
+class Registry(object):
+    '''
+    Counters, histograms and callback gauges rendered in the Prometheus text format.
+    '''
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self):
+        self._families = dict()
+        self._gauges = dict()
+
+    def _family(self, name, help, kind, labelnames, factory):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = Family(name, help, kind, labelnames, factory)
+        elif family.kind != kind or family.labelnames != tuple(labelnames):
+            raise ValueError('Metric %s already registered as %s%s' % (name, family.kind, family.labelnames))
+        return family
+
+    def counter(self, name, help, labelnames=()):
+        return self._family(name, help, 'counter', labelnames, Counter)
+
+    def histogram(self, name, help, labelnames=(), buckets=None):
+        return self._family(name, help, 'histogram', labelnames, lambda: Histogram(buckets))
+
+    def gauge(self, name, help, fn):
+        '''
+        Register a gauge read at render time; fn() returns (labels dict, value) pairs.
+        '''
+        self._gauges[name] = (help, fn)
+
+    def render(self):
+        lines = []
+        for family in self._families.values():
+            lines.append('# HELP %s %s' % (family.name, family.help))
+            lines.append('# TYPE %s %s' % (family.name, family.kind))
+            if family.kind == 'counter':
+                for values, c in family.children.items():
+                    lines.append('%s%s %s' % (family.name, _labels(family.labelnames, values), c.value))
+                continue
+            for values, h in family.children.items():
+                cumulative = 0
+                for le, n in zip(h.buckets + (float('inf'),), h.counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %d' % (family.name, _labels(family.labelnames, values, ('le', _number(le))), cumulative))
+                labels = _labels(family.labelnames, values)
+                lines.append('%s_sum%s %s' % (family.name, labels, _number(h.sum)))
+                lines.append('%s_count%s %d' % (family.name, labels, h.count))
+            if family.children:
+                name = '%s_quantile' % family.name
+                lines.append('# HELP %s Estimated quantiles of %s.' % (name, family.name))
+                lines.append('# TYPE %s gauge' % name)
+                for values, h in family.children.items():
+                    for q in self.QUANTILES:
+                        lines.append('%s%s %s' % (name, _labels(family.labelnames, values, ('quantile', q)), _number(h.quantile(q))))
+        for name, (help, fn) in self._gauges.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in fn():
+                lines.append('%s%s %s' % (name, _labels(labels.keys(), labels.values()), _number(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
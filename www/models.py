@@ -1,7 +1,8 @@
 #!/bin/bash env python3
 # -*- coding: utf-8 -*-
 
-from orm import Model, StringField, IntergerField, BooleanField, FloatField, TextField
+from orm import Model, StringField, IntergerField, BooleanField, FloatField, TextField, HasMany, Count
+from config import configs
 import time
 import uuid
 
@@ -10,7 +11,35 @@ Models for user, blog, comment.
 '''
 
 
-def next_id():
+# 按时间递增的紧凑主键: 15位毫秒时间戳 + 4位worker id + 4位毫秒内序号，共23个字符;
+# 同一毫秒内插入的行在聚簇索引里是连续的，不再像uuid那样随机插入;
+# 前缀与旧格式(15位时间戳 + uuid4 hex + 000，共50个字符)相同，新旧id可以放在同一列里并按时间排序;
+# 每个进程的worker id必须不同，在configs.ids.worker里配置
+class IdGenerator(object):
+
+    def __init__(self, worker=0):
+        if not 0 <= worker < 10000:
+            raise ValueError('Invalid worker id: %s' % worker)
+        self.worker = worker
+        self._last = 0
+        self._seq = 0
+
+    def __call__(self):
+        now = int(time.time() * 1000)
+        if now > self._last:
+            self._last, self._seq = now, 0
+        else:
+            # 同一毫秒内或者时钟回拨: 沿用上一次的时间戳，序号用完了就借用下一毫秒
+            self._seq += 1
+            if self._seq > 9999:
+                self._last, self._seq = self._last + 1, 0
+        return '%015d%04d%04d' % (self._last, self.worker, self._seq)
+
+
+next_id = IdGenerator(configs.get('ids', {}).get('worker', 0))
+
+
+def legacy_id():
     return '%015d%s000' % (int(time.time()) * 1000, uuid.uuid4().hex)
 
 # 注意到定义在User类中的__table__、id和name是类的属性，不是实例的属性;
@@ -19,6 +48,11 @@ def next_id():
 
 class User(Model):
     __table__ = 'users'
+    __cache__ = dict(size=1000, ttl=300)
+    __counts__ = dict(reconcile=300)
+    __indexes__ = [('created_at',)]
+    __unique__ = [('email',)]
+    __private__ = ('passwd',)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
@@ -31,6 +65,13 @@ class User(Model):
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = dict(size=500, ttl=300)
+    __counts__ = dict(reconcile=300)
+    __indexes__ = [('created_at',)]
+    __relations__ = dict(
+        comments=HasMany('Comment', 'blog_id', orderBy='created_at desc'),
+        comment_count=Count('Comment', 'blog_id')
+    )
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -44,13 +85,16 @@ class Blog(Model):
 
 class Comment(Model):
     __table__ = 'comments'
+    __counts__ = dict(reconcile=300)
+    __indexes__ = [('blog_id', 'created_at'), ('created_at',)]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
+    # 评论列表总要显示内容，所以不延迟加载
+    content = TextField(deferred=False)
     created_at = FloatField(default=time.time)
 
 # 在编写ORM时，给一个Field增加一个default参数可以让ORM自己填入缺省值，非常方便;
@@ -8,18 +8,68 @@
 
 import asyncio
 import aiomysql
+import collections
+import contextlib
+import contextvars
+import functools
+import itertools
+import re
+import time
 import logging
+from metrics import REGISTRY
+from tracing import span
 logging.basicConfig(level=logging.INFO)
 
 
 def log(sql, args):
-    logging.info('SQL: %s (Args: %s)' % (sql, args))
+    logging.info('SQL: %s (Args: %s)', sql, args)
 
 
+# SQL语句缓存: ?占位符替换成驱动需要的%s只做一次，之后直接查表;
+# ModelMetaclass生成的语句在类创建时就已经替换好了
+_statements = dict()
+_MAX_STATEMENTS = 1024
+
+
+def statement(sql):
+    s = _statements.get(sql)
+    if s is None:
+        if len(_statements) >= _MAX_STATEMENTS:
+            _statements.clear()
+        s = _statements[sql] = sql.replace('?', '%s')
+    return s
+
+
+# 读写分离: 配置replicas后，select()从只读副本中选一个连接池，execute()总是走主库;
+# 事务内的读取，以及同一个请求里写过数据库之后的读取，都走主库，保证读到自己刚写入的数据;
+# replica_policy可以是'round_robin'或'least_loaded'(选正在使用的连接最少的副本)
 async def create_pool(loop, **kw):
     logging.info('create database connection pool')
-    global __pool
-    __pool = await aiomysql.create_pool(
+    global __pool, __replicas, _coalesce, _replica_policy, _wait_warning
+    _coalesce = kw.get('coalesce', False)
+    _wait_warning = kw.get('wait_warning', 0.1)
+    _pool_stats.clear()
+    _replica_policy = kw.get('replica_policy', 'round_robin')
+    if _replica_policy not in ('round_robin', 'least_loaded'):
+        raise ValueError('Invalid replica_policy: %s' % _replica_policy)
+    __pool = await _create_pool(loop, kw)
+    _pool_stats[__pool] = PoolStats('primary', __pool)
+    __replicas = []
+    for i, replica in enumerate(kw.get('replicas', ())):
+        logging.info('create replica connection pool: %s:%s' % (replica.get('host'), replica.get('port', 3306)))
+        pool = await _create_pool(loop, dict(kw, **replica))
+        _pool_stats[pool] = PoolStats('replica%d' % i, pool)
+        __replicas.append(pool)
+    # 预热: 开始接受请求之前先建立好warmup个连接
+    warmup = kw.get('warmup', 0)
+    if warmup:
+        for stats in _pool_stats.values():
+            await warmup_pool(stats.pool, warmup)
+    _start_maintenance(loop, kw.get('keepalive', 0), kw.get('autoscale', None))
+
+
+async def _create_pool(loop, kw):
+    return await aiomysql.create_pool(
         host=kw.get('host', '10.0.0.2'),
         port=kw.get('port', 3306),
         user=kw['user'],
@@ -32,22 +82,392 @@ async def create_pool(loop, **kw):
         loop=loop)
 
 
+# 连接池监控: 每次取连接记录等待时间和占用时间，等待超过wait_warning秒时打警告;
+# pool_stats()返回每个连接池的直方图和当前使用中/空闲的连接数
+
+
+_pool_wait = REGISTRY.histogram('orm_pool_wait_seconds', 'Time spent waiting for a pooled connection.', ('pool',))
+_pool_hold = REGISTRY.histogram('orm_pool_hold_seconds', 'Time a pooled connection was held.', ('pool',))
+_query_seconds = REGISTRY.histogram('orm_query_seconds', 'Time spent running SQL statements.', ('kind',))
+_select_seconds = _query_seconds.labels('select')
+_execute_seconds = _query_seconds.labels('execute')
+
+
+class PoolStats(object):
+    '''
+    Checkout wait and hold time histograms plus gauges for one connection pool.
+    '''
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.wait = _pool_wait.labels(name)
+        self.hold = _pool_hold.labels(name)
+        self.waiting = 0
+        self.slow_waits = 0
+        # 上一次autoscale检查以来使用中连接数的峰值，以及当时的slow_waits
+        self.peak_in_use = 0
+        self.last_slow_waits = 0
+
+    def snapshot(self):
+        size, free = self.pool.size, self.pool.freesize
+        return dict(name=self.name, size=size, free=free, in_use=size - free, waiting=self.waiting,
+                    minsize=self.pool.minsize, maxsize=self.pool.maxsize, slow_waits=self.slow_waits,
+                    wait=self.wait.summary(), hold=self.hold.summary())
+
+
+class _Checkout(object):
+    '''
+    Acquire a connection from a pool, recording wait and hold times.
+    '''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.stats = _pool_stats.get(pool)
+        self.conn = None
+        self.wait = 0.0
+        self._acquired = None
+
+    async def acquire(self):
+        stats = self.stats
+        start = time.perf_counter()
+        stats.waiting += 1
+        try:
+            self.conn = await self.pool.acquire()
+        finally:
+            stats.waiting -= 1
+        self._acquired = time.perf_counter()
+        self.wait = self._acquired - start
+        stats.wait.observe(self.wait)
+        stats.peak_in_use = max(stats.peak_in_use, self.pool.size - self.pool.freesize)
+        if self.wait > _wait_warning:
+            stats.slow_waits += 1
+            logging.warning('waited %.3fs for a connection from pool %s (in use %s/%s)' %
+                            (self.wait, stats.name, self.pool.size - self.pool.freesize, self.pool.maxsize))
+        return self.conn
+
+    def release(self):
+        hold = time.perf_counter() - self._acquired
+        self.stats.hold.observe(hold)
+        if self.pool.size > self.pool.maxsize:
+            # 连接池刚被缩小，多出来的连接直接关掉
+            self.conn.close()
+        self.pool.release(self.conn)
+        # 关闭的连接(缩小连接池时多出来的，或者iterselect()提前停止时关掉的)释放后要自己唤醒等待者
+        if self.conn.closed:
+            _wake_waiters(self.pool)
+        logging.debug('connection from pool %s: wait %.1fms, hold %.1fms', self.stats.name, self.wait * 1000, hold * 1000)
+
+    async def __aenter__(self):
+        return await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+_pool_stats = dict()
+_wait_warning = 0.1
+
+
+def pool_stats():
+    return [stats.snapshot() for stats in _pool_stats.values()]
+
+
+def _pool_gauge(attr):
+    def collect():
+        for stats in _pool_stats.values():
+            pool = stats.pool
+            values = dict(size=pool.size, free=pool.freesize, in_use=pool.size - pool.freesize,
+                          maxsize=pool.maxsize, waiting=stats.waiting)
+            yield dict(pool=stats.name), values[attr]
+    return collect
+
+
+for _attr, _help in (('size', 'Open connections.'), ('in_use', 'Connections checked out.'),
+                     ('free', 'Idle connections.'), ('maxsize', 'Pool size limit.'),
+                     ('waiting', 'Coroutines waiting for a connection.')):
+    REGISTRY.gauge('orm_pool_%s' % _attr, _help, _pool_gauge(_attr))
+
+
+# 连接池维护:
+# warmup_pool()同时取出n个连接再放回，让连接池在启动时就建好连接;
+# keepalive秒一次ping空闲连接，提前发现被服务器断开的连接;
+# autoscale = dict(min=1, max=30, interval=10, step=2)时，每interval秒根据等待情况在[min, max]之间调整maxsize:
+# 有等待超过wait_warning的请求或者有正在排队的请求就扩大，峰值使用量比maxsize小step以上就缩小
+_autoscale = dict()
+_maintenance = []
+
+
+async def warmup_pool(pool, n):
+    n = min(n, pool.maxsize)
+    if n > pool.minsize:
+        resize_pool(pool, minsize=n)
+    conns = []
+    try:
+        for i in range(n):
+            conns.append(await pool.acquire())
+    finally:
+        for conn in conns:
+            pool.release(conn)
+    logging.info('warmed up connection pool %s: %s connections' % (_pool_stats[pool].name, pool.size))
+
+
+# aiomysql的release()放回关闭的连接时不通知等待者，resize_pool()扩大maxsize也不会通知，
+# 空出来的名额要等到下一次正常release()才交给排队的请求，所以这些地方要自己唤醒等待者
+_wakeups = set()
+
+
+def _wake_waiters(pool):
+    async def wakeup():
+        async with pool._cond:
+            pool._cond.notify_all()
+    task = asyncio.ensure_future(wakeup())
+    _wakeups.add(task)
+    task.add_done_callback(_wakeups.discard)
+
+
+def resize_pool(pool, minsize=None, maxsize=None):
+    '''
+    Change pool limits at runtime. aiomysql has no public API for this, so the private _minsize
+    and the maxlen of the _free deque are replaced.
+    '''
+    if maxsize is not None:
+        if minsize is None and maxsize < pool.minsize:
+            minsize = maxsize
+        free = pool._free
+        while len(free) > maxsize:
+            free.popleft().close()
+        pool._free = collections.deque(free, maxlen=maxsize)
+    if minsize is not None:
+        pool._minsize = min(minsize, pool.maxsize)
+    _wake_waiters(pool)
+    logging.info('resize connection pool %s: minsize=%s, maxsize=%s' % (_pool_stats[pool].name, pool.minsize, pool.maxsize))
+
+
+def set_pool_size(name, minsize=None, maxsize=None):
+    'resize the pool named primary, replica0, ...'
+    for stats in _pool_stats.values():
+        if stats.name == name:
+            resize_pool(stats.pool, minsize, maxsize)
+            return
+    raise ValueError('Invalid pool name: %s' % name)
+
+
+def set_autoscale(**kw):
+    'change autoscale min, max, interval or step at runtime'
+    for k in kw:
+        if k not in ('min', 'max', 'interval', 'step'):
+            raise ValueError('Invalid autoscale option: %s' % k)
+    _autoscale.update(kw)
+
+
+# 空闲连接逐个取出ping再放回(先进先出，每个空闲连接各轮到一次)，不同时占住所有空闲连接;
+# 请求把空闲连接用完时就停止，不为了ping去等待或新建连接
+async def ping_idle(pool):
+    for _ in range(pool.freesize):
+        if not pool.freesize:
+            break
+        conn = await pool.acquire()
+        try:
+            await conn.ping(reconnect=False)
+        except Exception as e:
+            logging.warning('dropping dead connection from pool %s: %s' % (_pool_stats[pool].name, e))
+            conn.close()
+        finally:
+            pool.release(conn)
+            if conn.closed:
+                _wake_waiters(pool)
+
+
+def autoscale_pool(stats):
+    pool = stats.pool
+    step = _autoscale.get('step', 2)
+    slow, stats.last_slow_waits = stats.slow_waits - stats.last_slow_waits, stats.slow_waits
+    peak, stats.peak_in_use = stats.peak_in_use, pool.size - pool.freesize
+    if (slow or stats.waiting) and pool.maxsize < _autoscale['max']:
+        resize_pool(pool, maxsize=min(pool.maxsize + step, _autoscale['max']))
+    elif not slow and peak + step <= pool.maxsize and pool.maxsize > _autoscale['min']:
+        resize_pool(pool, maxsize=max(pool.maxsize - step, _autoscale['min'], peak))
+
+
+async def _every(seconds, fn):
+    while True:
+        await asyncio.sleep(seconds() if callable(seconds) else seconds)
+        for stats in list(_pool_stats.values()):
+            try:
+                await fn(stats)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception(e)
+
+
+def _start_maintenance(loop, keepalive, autoscale):
+    for task in _maintenance:
+        task.cancel()
+    del _maintenance[:]
+    loop = loop or asyncio.get_event_loop()
+    if keepalive:
+        async def keep(stats):
+            await ping_idle(stats.pool)
+        _maintenance.append(loop.create_task(_every(keepalive, keep)))
+    _autoscale.clear()
+    if autoscale:
+        _autoscale.update(dict(min=1, max=10, interval=10, step=2), **autoscale)
+
+        async def scale(stats):
+            autoscale_pool(stats)
+        _maintenance.append(loop.create_task(_every(lambda: _autoscale['interval'], scale)))
+
+
+async def close_pool():
+    for task in _maintenance:
+        task.cancel()
+    del _maintenance[:]
+    for stats in list(_pool_stats.values()):
+        stats.pool.close()
+        await stats.pool.wait_closed()
+    _pool_stats.clear()
+
+
+__replicas = []
+_replica_policy = 'round_robin'
+_replica_turn = itertools.count()
+# 请求级别的状态，由request_scope()设置: wrote为True后本请求的读取都走主库
+_request_state = contextvars.ContextVar('request_state', default=None)
+
+
+def _read_pool():
+    if not __replicas:
+        return __pool
+    state = _request_state.get()
+    if state is not None and state['wrote']:
+        return __pool
+    turn = next(_replica_turn)
+    if _replica_policy == 'least_loaded':
+        n = len(__replicas)
+        return min((__replicas[(turn + i) % n] for i in range(n)), key=lambda p: p.size - p.freesize)
+    return __replicas[turn % len(__replicas)]
+
+
+def _mark_write():
+    state = _request_state.get()
+    if state is not None:
+        state['wrote'] = True
+
+
+@contextlib.contextmanager
+def request_scope():
+    '''
+    Per-request ORM state: a Loader for Model.find() and read-your-writes routing to the primary.
+    '''
+    loader_token = request_loader.set(Loader())
+    state_token = _request_state.set(dict(wrote=False))
+    try:
+        yield
+    finally:
+        _request_state.reset(state_token)
+        request_loader.reset(loader_token)
+
+
 # Select
 # 要执行SELECT语句，用select函数执行，需要传入SQL语句和SQL参数
 
 
-async def select(sql, args, size=None):
+# 合并并发的相同SELECT (singleflight): SQL和参数完全相同的查询同时只发一条，
+# 其余调用者等待同一个结果，各自拿到一份行数据的拷贝;
+# 需要在create_pool()时传入coalesce=True打开，事务内部通过coalescing = False关闭
+_coalesce = False
+_inflight = dict()
+_coalesce_stats = dict(queries=0, coalesced=0)
+coalescing = contextvars.ContextVar('coalescing', default=True)
+
+
+def coalesce_stats():
+    return dict(_coalesce_stats, inflight=len(_inflight))
+
+
+# tuples=True时用普通游标，每行是一个tuple，不再为每行创建dict;
+# primary=True时总是读主库: 进程级缓存只能用主库的数据填充，副本的延迟数据会在缓存里留到过期;
+# 共享的查询在单独的task里运行，每个调用者通过shield()等待，某个调用者被取消只影响它自己;
+# 本次请求写过数据库之后要读主库，不能加入可能发往副本的查询，因此不参与合并
+async def select(sql, args, size=None, tuples=False, primary=False):
+    state = _request_state.get()
+    if not (_coalesce and coalescing.get()) or _transaction.get() is not None or (state is not None and state['wrote']):
+        return await _select(sql, args, size, tuples, primary)
+    key = (sql, tuple(args or ()), size, tuples, primary)
+    task = _inflight.get(key)
+    if task is not None:
+        _coalesce_stats['coalesced'] += 1
+        rs = await asyncio.shield(task)
+        return list(rs) if tuples else [dict(r) for r in rs]
+    task = _inflight[key] = asyncio.ensure_future(_select(sql, args, size, tuples, primary))
+    task.add_done_callback(functools.partial(_query_done, key))
+    _coalesce_stats['queries'] += 1
+    return await asyncio.shield(task)
+
+
+def _query_done(key, task):
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    # 所有调用者都已取消时没有人取结果，避免'exception was never retrieved'警告
+    if not task.cancelled():
+        task.exception()
+
+
+async def _select(sql, args, size=None, tuples=False, primary=False):
     log(sql, args)
-    with (await __pool) as conn:
-        cur = await conn.cursor(aiomysql.DictCursor)
-        await cur.execute(sql.replace('?', '%s'), args or ())
-        if size:
-            rs = await cur.fetchmany(size)
-        else:
-            rs = await cur.fetchall()
-        await cur.close()
-        logging.info('rows returned: %s' % len(rs))
-        return rs
+    with span('select', sql=sql):
+        tx = _transaction.get()
+        if tx is not None:
+            async with tx.lock:
+                return await _fetch(tx.conn, sql, args, size, tuples)
+        async with _Checkout(__pool if primary else _read_pool()) as conn:
+            return await _fetch(conn, sql, args, size, tuples)
+
+
+async def _fetch(conn, sql, args, size=None, tuples=False):
+    start = time.perf_counter()
+    cur = await conn.cursor(aiomysql.Cursor if tuples else aiomysql.DictCursor)
+    await cur.execute(statement(sql), args or ())
+    if size:
+        rs = await cur.fetchmany(size)
+    else:
+        rs = await cur.fetchall()
+    await cur.close()
+    _select_seconds.observe(time.perf_counter() - start)
+    logging.info('rows returned: %s' % len(rs))
+    return rs
+
+
+# 大结果集用iterselect()逐批读取: 使用不缓冲的服务端游标SSDictCursor，内存占用与表大小无关;
+# 调用者提前停止迭代时，结果集还没读完，直接关闭连接而不是把剩余的行读完，连接池会丢弃已关闭的连接
+
+
+async def iterselect(sql, args, batch=100):
+    if _transaction.get() is not None:
+        # 事务的连接是共用的，不能被未读完的服务端游标占住，只能一次读出再分批返回
+        rs = await _select(sql, args)
+        for i in range(0, len(rs), batch):
+            yield rs[i:i + batch]
+        return
+    log(sql, args)
+    async with _Checkout(_read_pool()) as conn:
+        cur = await conn.cursor(aiomysql.SSDictCursor)
+        done = False
+        try:
+            await cur.execute(statement(sql), args or ())
+            while True:
+                rs = await cur.fetchmany(batch)
+                if not rs:
+                    break
+                yield rs
+            done = True
+        finally:
+            if done:
+                await cur.close()
+            else:
+                conn.close()
 
 
 # SQL语句的占位符是?，而MySQL的占位符是%s，select()函数在内部自动替换;
@@ -62,15 +482,147 @@ async def select(sql, args, size=None):
 # execute()函数和select()函数所不同的是，cursor对象不返回结果集，而是通过rowcount返回结果数
 async def execute(sql, args):
     log(sql, args)
-    with (await __pool) as conn:
+    _mark_write()
+    with span('execute', sql=sql):
+        tx = _transaction.get()
+        if tx is not None:
+            async with tx.lock:
+                return await _run(tx.conn, sql, args)
+        async with _Checkout(__pool) as conn:
+            return await _run(conn, sql, args)
+
+
+async def _run(conn, sql, args):
+    start = time.perf_counter()
+    try:
+        cur = await conn.cursor()
+        await cur.execute(statement(sql), args)
+        affected = cur.rowcount
+        await cur.close()
+    except BaseException as e:
+        raise
+    _execute_seconds.observe(time.perf_counter() - start)
+    return affected
+
+# 事务
+# async with orm.transaction() as tx:
+#     await blog.remove()
+#     await Comment.removeAll('blog_id=?', [blog.id])
+# 事务开始时从连接池取出一个连接，放在contextvar里，块内所有select()/execute()以及Model的方法都用这个连接;
+# 块正常结束时提交，抛出异常时回滚;在事务内再进入orm.transaction()或tx.savepoint()会创建SAVEPOINT;
+# 事务内读取不经过主键缓存和Loader，回滚时清掉涉及到的Model的缓存和计数，避免缓存未提交的数据
+_transaction = contextvars.ContextVar('transaction', default=None)
+_savepoint_ids = itertools.count(1)
+
+
+def _checkout_primary():
+    return _Checkout(__pool)
+
+
+class Transaction(object):
+    '''
+    Async context manager pinning one connection for a transaction or savepoint.
+    '''
+
+    def __init__(self):
+        self.conn = None
+        self.lock = None
+        self.touched = set()
+        self._checkout = None
+        self._parent = None
+        self._savepoint = None
+        self._token = None
+        self._done = False
+
+    async def __aenter__(self):
+        self._parent = _transaction.get()
+        if self._parent is None:
+            self._checkout = _checkout_primary()
+            self.conn = await self._checkout.acquire()
+            self.lock = asyncio.Lock()
+            try:
+                await self.conn.begin()
+            except BaseException:
+                self._checkout.release()
+                raise
+        else:
+            self.conn = self._parent.conn
+            self.lock = self._parent.lock
+            self._savepoint = 'sp_%d' % next(_savepoint_ids)
+            await self._command('savepoint `%s`' % self._savepoint)
+        self._token = _transaction.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
         try:
-            cur = await conn.cursor()
-            await cur.execute(sql.replace('?', '%s'), args)
-            affected = cur.rowcount
+            if not self._done:
+                if exc_type is None:
+                    try:
+                        await self.commit()
+                    except BaseException:
+                        await self.rollback()
+                        raise
+                else:
+                    await self.rollback()
+        finally:
+            _transaction.reset(self._token)
+            if self._parent is None:
+                self._checkout.release()
+            else:
+                self._parent.touched.update(self.touched)
+
+    def savepoint(self):
+        'nested savepoint, use as: async with tx.savepoint(): ...'
+        return Transaction()
+
+    async def commit(self):
+        self._done = True
+        if self._savepoint:
+            await self._command('release savepoint `%s`' % self._savepoint)
+        else:
+            try:
+                async with self.lock:
+                    await self.conn.commit()
+            finally:
+                # 事务期间其他请求可能把提交前的旧数据读进了缓存，提交后整体丢弃
+                for cls in self.touched:
+                    cls._forgetAll()
+
+    async def rollback(self):
+        self._done = True
+        try:
+            if self._savepoint:
+                await self._command('rollback to savepoint `%s`' % self._savepoint)
+            else:
+                async with self.lock:
+                    await self.conn.rollback()
+        finally:
+            for cls in self.touched:
+                cls._forgetAll()
+
+    async def _command(self, sql):
+        log(sql, None)
+        async with self.lock:
+            cur = await self.conn.cursor()
+            await cur.execute(sql)
             await cur.close()
-        except BaseException as e:
-            raise
-        return affected
+
+
+def transaction():
+    return Transaction()
+
+
+# MySQL错误码1062: 违反主键或唯一索引
+ER_DUP_ENTRY = 1062
+
+
+def is_duplicate(e):
+    'True if e is the IntegrityError raised for a duplicate primary or unique key'
+    return isinstance(e, aiomysql.IntegrityError) and bool(e.args) and e.args[0] == ER_DUP_ENTRY
+
+
+def in_transaction():
+    return _transaction.get() is not None
 
 # ORM
 # 有了基本的select()和execute()函数，我们就可以开始编写一个简单的ORM了。
@@ -80,11 +632,13 @@ async def execute(sql, args):
 
 
 class Field(object):
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, deferred=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        # deferred的列不在findAll()的默认查询里，需要时用load()单独加载
+        self.deferred = deferred
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -112,8 +666,366 @@ class FloatField(Field):
 
 
 class TextField(Field):
-    def __init__(self, name=None, primary_key=False, ddl='text', default=None):
-        super(TextField, self).__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, ddl='text', default=None, deferred=True):
+        super(TextField, self).__init__(name, ddl, primary_key, default, deferred)
+
+# 按主键缓存的行数据，LRU淘汰，可选ttl（秒）;
+# 缓存的是select返回的原始行，find()每次都用它构造新的Model对象，调用者修改对象不会污染缓存;
+# save()/update()/remove()之后会自动失效对应的主键
+
+
+class ModelCache(object):
+    '''
+    In-process LRU cache of rows keyed by primary key.
+    '''
+
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # 每次失效都递增，防止失效前发出的select把旧数据写回缓存
+        self.version = 0
+        self._rows = collections.OrderedDict()
+
+    def get(self, pk):
+        entry = self._rows.get(pk)
+        if entry is not None:
+            row, expires = entry
+            if expires is None or expires > time.monotonic():
+                self._rows.move_to_end(pk)
+                self.hits += 1
+                return row
+            del self._rows[pk]
+        self.misses += 1
+        return None
+
+    def put(self, pk, row, version=None):
+        if version is not None and version != self.version:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._rows[pk] = (row, expires)
+        self._rows.move_to_end(pk)
+        while len(self._rows) > self.size:
+            self._rows.popitem(last=False)
+
+    def invalidate(self, pk=None):
+        self.version += 1
+        if pk is None:
+            self._rows.clear()
+        else:
+            self._rows.pop(pk, None)
+
+    def stats(self):
+        return dict(size=len(self._rows), maxsize=self.size, ttl=self.ttl, hits=self.hits, misses=self.misses)
+
+# findNumber()的计数缓存，按(selectField, where, args)保存;
+# 不带where的全表计数由save()/remove()增减维护，带where的计数在任何写入后丢弃，下次重新查询;
+# 超过reconcile秒的计数会重新从数据库读取，reconcile为0或None时不过期，只靠写入维护; approximate=True时全表计数读information_schema里的统计值，不扫描索引
+
+
+class CountCache(object):
+    '''
+    Cached row counts for Model.findNumber(), kept up to date by writes.
+    '''
+
+    def __init__(self, reconcile=300, approximate=False):
+        self.reconcile = reconcile
+        self.approximate = approximate
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+        self._counts = dict()
+
+    def get(self, key):
+        entry = self._counts.get(key)
+        if entry is not None:
+            if not self.reconcile or entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+            del self._counts[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, count, incremental, version=None):
+        if version is not None and version != self.version:
+            return
+        expires = time.monotonic() + self.reconcile if self.reconcile else None
+        self._counts[key] = [count, expires, incremental]
+
+    def add(self, delta):
+        self.version += 1
+        for key, entry in list(self._counts.items()):
+            if entry[2]:
+                entry[0] += delta
+            else:
+                del self._counts[key]
+
+    def clear(self):
+        self.version += 1
+        self._counts.clear()
+
+    def stats(self):
+        return dict(size=len(self._counts), reconcile=self.reconcile, approximate=self.approximate,
+                    hits=self.hits, misses=self.misses)
+
+
+# 请求级别的Loader: 同一轮事件循环里发出的Model.find()合并成一条where id in (...)查询;
+# 查到的行在本次请求内缓存，重复的主键只查一次;
+# 由app.py的middleware为每个请求设置request_loader，没有设置时find()照常单独查询
+
+
+class Loader(object):
+    '''
+    Request-scoped batching and memoizing of Model.find() lookups.
+    '''
+
+    def __init__(self):
+        self._rows = dict()
+        self._pending = dict()
+
+    async def load(self, cls, pk):
+        key = (cls, pk)
+        fut = self._rows.get(key)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            fut = self._rows[key] = loop.create_future()
+            pending = self._pending.get(cls)
+            if pending is None:
+                pending = self._pending[cls] = []
+                loop.call_soon(self._dispatch, cls)
+            pending.append((pk, fut))
+        return await asyncio.shield(fut)
+
+    def _dispatch(self, cls):
+        asyncio.ensure_future(self._fetch(cls, self._pending.pop(cls)))
+
+    # 查询期间forget()可能已经把future从_rows里移除，所以直接完成分发时记下的future;
+    # 这个task没有人await，出错时只把异常交给等待的调用者，不再抛出
+    async def _fetch(self, cls, pending):
+        try:
+            rows = await cls._findRows([pk for pk, fut in pending])
+        except BaseException as e:
+            for pk, fut in pending:
+                if self._rows.get((cls, pk)) is fut:
+                    del self._rows[(cls, pk)]
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for pk, fut in pending:
+            if not fut.done():
+                fut.set_result(rows.get(pk))
+
+    def forget(self, cls, pk):
+        self._rows.pop((cls, pk), None)
+
+    def forgetAll(self, cls):
+        for key in [k for k in self._rows if k[0] is cls]:
+            del self._rows[key]
+
+
+request_loader = contextvars.ContextVar('request_loader', default=None)
+
+# 紧凑的行对象: ModelMetaclass为每个Model生成一个带__slots__的Row子类(如BlogRow)，
+# 直接用普通游标返回的tuple填充，不创建dict，内存占用只有Model对象的一小部分;
+# Row对象是只读快照，用于列表和JSON输出，需要修改或保存时仍然用Model
+
+
+class Row(object):
+    '''
+    Base class of the compact __slots__ row classes generated for each model.
+    '''
+
+    __slots__ = ()
+
+    def keys(self):
+        return [k for k in self.__slots__ if hasattr(self, k)]
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.keys()}
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.to_dict())
+
+
+def _make_row_class(name, columns):
+    return type('%sRow' % name, (Row,), dict(__slots__=tuple(columns), __makers__=dict()))
+
+
+def _row_maker(row_cls, columns):
+    '''
+    Generate a function building a row_cls object from a tuple in the given column order.
+    '''
+    maker = row_cls.__makers__.get(columns)
+    if maker is None:
+        lines = ['def make(t):', '    o = new(cls)']
+        lines.extend('    o.%s = t[%d]' % (c, i) for i, c in enumerate(columns))
+        lines.append('    return o')
+        ns = dict(new=object.__new__, cls=row_cls)
+        exec('\n'.join(lines), ns)
+        maker = row_cls.__makers__[columns] = ns['make']
+    return maker
+
+
+# save()/update()的参数提取函数也在创建类时生成: 每个字段一次dict.get，缺省值直接内联，
+# 代替对每个字段调用getValueOrDefault()(getattr -> __getattr__ -> __mappings__查找 -> callable判断)
+
+
+def _make_args_function(name, mappings, fields, plain=(), assign=False):
+    '''
+    Generate fn(obj) returning the args list for fields (defaults applied) followed by plain (no defaults).
+    With assign=True generated defaults are also stored on obj, as getValueOrDefault() did.
+    '''
+    lines = ['def %s(obj):' % name, '    get = obj.get']
+    ns = dict()
+    values = []
+    for i, f in enumerate(list(fields) + list(plain)):
+        v = 'v%d' % i
+        values.append(v)
+        lines.append('    %s = get(%r)' % (v, f))
+        default = mappings[f].default if i < len(fields) else None
+        if default is not None:
+            ns['d%d' % i] = default
+            lines.append('    if %s is None:' % v)
+            lines.append('        %s = d%d%s' % (v, i, '()' if callable(default) else ''))
+            if assign:
+                lines.append('        obj[%r] = %s' % (f, v))
+    lines.append('    return [%s]' % ', '.join(values))
+    exec('\n'.join(lines), ns)
+    return ns[name]
+
+
+# 关联关系: 在Model上用__relations__声明，findAll(..., prefetch=['comments'])时一次查出所有父对象的关联数据，
+# 在内存里按主键拼到父对象上，避免N+1查询:
+#     __relations__ = dict(comments=HasMany('Comment', 'blog_id', orderBy='created_at desc'),
+#                          comment_count=Count('Comment', 'blog_id'))
+# 关联的Model可以用类名字符串引用，在第一次使用时才查找，所以可以引用后面才定义的类
+_models = dict()
+
+
+class Relation(object):
+    def __init__(self, model, key, **kw):
+        self._model = model
+        self.key = key
+        self.kw = kw
+
+    @property
+    def model(self):
+        if isinstance(self._model, str):
+            self._model = _models[self._model]
+        return self._model
+
+    def _in(self, pks):
+        return '`%s` in (%s)' % (self.key, ', '.join(['?'] * len(pks)))
+
+
+class HasMany(Relation):
+    '''
+    Rows of model whose key column holds the parent's primary key, loaded with one IN query.
+    '''
+
+    async def fetch(self, pks):
+        groups = {pk: [] for pk in pks}
+        for child in await self.model.findAll(self._in(pks), pks, **self.kw):
+            groups[child[self.key]].append(child)
+        return groups
+
+    def empty(self):
+        return []
+
+
+class Count(Relation):
+    '''
+    Number of rows of model pointing at each parent, loaded with one GROUP BY query.
+    '''
+
+    async def fetch(self, pks):
+        sql = 'select `%s` as _key_, count(*) as _num_ from `%s` where %s group by `%s`' % (
+            self.key, self.model.__table__, self._in(pks), self.key)
+        counts = {pk: 0 for pk in pks}
+        for r in await select(sql, pks):
+            counts[r['_key_']] = r['_num_']
+        return counts
+
+    def empty(self):
+        return 0
+
+
+# 索引声明: __indexes__和__unique__是列名tuple的列表，例如:
+#     __indexes__ = [('blog_id', 'created_at'), ('created_at',)]
+#     __unique__ = [('email',)]
+# 主键总是有索引;create_table_sql()生成建表语句，schema.py根据声明比较并补上数据库里缺少的索引;
+# findAll()/findNumber()第一次生成某种SQL时，检查where和order by用到的列有没有可用的索引，
+# 可能全表扫描的查询记录在full_scans()里并打警告
+_RE_WHERE_COLUMN = re.compile(r'`?(\w+)`?\s*(?:=|<|>|!=|\bin\b|\blike\b|\bis\b|\bbetween\b)', re.I)
+_full_scans = collections.OrderedDict()
+
+
+def _index_name(table, columns, unique):
+    return '%s_%s_%s' % ('uq' if unique else 'idx', table, '_'.join(columns))
+
+
+def create_table_sql(cls):
+    'CREATE TABLE statement with the columns and declared indexes of a model'
+    lines = []
+    for k in [cls.__primary_key__] + cls.__fields__:
+        f = cls.__mappings__[k]
+        lines.append('  `%s` %s%s' % (k, f.column_type, ' not null' if f.primary_key else ''))
+    lines.append('  primary key (`%s`)' % cls.__primary_key__)
+    for index in cls.__indexes__:
+        lines.append('  %skey `%s` (%s)' % ('unique ' if index['unique'] else '', index['name'],
+                                             ', '.join('`%s`' % c for c in index['columns'])))
+    return 'create table if not exists `%s` (\n%s\n) engine=innodb default charset=utf8' % (cls.__table__, ',\n'.join(lines))
+
+
+def add_index_sql(cls, index):
+    return 'alter table `%s` add %sindex `%s` (%s)' % (cls.__table__, 'unique ' if index['unique'] else '', index['name'],
+                                                       ', '.join('`%s`' % c for c in index['columns']))
+
+
+def _normalize_order(orderBy):
+    return tuple(' '.join(part.replace('`', '').lower().split()) for part in orderBy.split(','))
+
+
+def full_scans():
+    'queries seen so far that no declared index can serve'
+    return list(_full_scans.values())
+
+
+def _full_scan_gauge():
+    tables = collections.Counter(scan['table'] for scan in _full_scans.values())
+    for table, n in sorted(tables.items()):
+        yield dict(table=table), n
+
+
+REGISTRY.gauge('orm_full_scan_queries', 'Query shapes seen so far that no declared index can serve.', _full_scan_gauge)
+
+
+def _check_scan(cls, where, orderBy, limited):
+    leading = set([cls.__primary_key__] + [index['columns'][0] for index in cls.__indexes__])
+    reason = None
+    if where:
+        columns = [c for c in _RE_WHERE_COLUMN.findall(where) if c in cls.__mappings__]
+        if columns and not leading.intersection(columns):
+            reason = 'no index on %s' % ', '.join(columns)
+    elif orderBy:
+        column = orderBy.split(',')[0].split()[0].strip('`')
+        if column not in leading:
+            reason = 'no index on order by %s' % column
+    elif not limited:
+        reason = 'unbounded select without where'
+    if reason:
+        key = (cls.__table__, where, orderBy)
+        if key not in _full_scans:
+            logging.warning('query on %s may scan the whole table (%s): where=%s, orderBy=%s' % (cls.__table__, reason, where, orderBy))
+            _full_scans[key] = dict(table=cls.__table__, where=where, orderBy=orderBy, reason=reason)
+
 
 # 注意到Model只是一个基类，如何将具体的子类如User的映射信息读取出来呢？答案就是通过metaclass：ModelMetaclass
 
@@ -157,24 +1069,68 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey  # 主键属性名
         attrs['__fields__'] = fields  # 除主属性外的属性名
+        attrs['__deferred__'] = frozenset(f for f in fields if mappings[f].deferred)  # 延迟加载的属性名
+        # 可选的主键缓存: __cache__ = dict(size=1000, ttl=60)
+        cache = attrs.get('__cache__', None)
+        attrs['__cache__'] = ModelCache(**cache) if cache else None
+        # 可选的计数缓存: __counts__ = dict(reconcile=300, approximate=False)
+        counts = attrs.get('__counts__', None)
+        attrs['__counts__'] = CountCache(**counts) if counts else None
         # 构造默认的SELECT, INSERT, UPDATE和DELETE语句
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (
             primaryKey, ', '.join(escaped_fields), tableName)
+        # findAll()默认使用的SELECT，不含deferred列
+        attrs['__select_eager__'] = 'select `%s`, %s from `%s`' % (
+            primaryKey, ', '.join('`%s`' % f for f in fields if not mappings[f].deferred), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (
             tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+        # save_many()在__insert__后面追加的每一行占位符
+        attrs['__insert_row__'] = '(%s)' % create_args_string(len(escaped_fields) + 1)
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (
             tableName, ', '.join(
                 map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)),
             primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (
             tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__find__'] = '%s where `%s`=?' % (attrs['__select__'], primaryKey)
+        # 预先替换成驱动的%s占位符
+        for k in ('__select__', '__select_eager__', '__insert__', '__insert_row__', '__update__', '__delete__', '__find__'):
+            attrs[k] = attrs[k].replace('?', '%s')
+        # findAll()/findNumber()按(where, orderBy, limit形式...)缓存拼好的SQL
+        attrs['__statements__'] = dict()
+        # findRows()返回的紧凑行类
+        attrs['__row__'] = _make_row_class(name, [primaryKey] + fields)
+        # 按__insert__和__update__的参数顺序生成参数列表，作为staticmethod保存
+        attrs['__insert_args__'] = staticmethod(_make_args_function('insert_args', mappings, fields + [primaryKey], assign=True))
+        attrs['__update_args__'] = staticmethod(_make_args_function('update_args', mappings, fields, [primaryKey]))
+        attrs['__relations__'] = attrs.get('__relations__', None) or dict()
+        # 序列化为JSON时去掉的字段，例如密码
+        attrs['__private__'] = frozenset(attrs.get('__private__', None) or ())
+        indexes = []
+        for unique, declared in ((False, attrs.get('__indexes__', None)), (True, attrs.get('__unique__', None))):
+            for columns in declared or ():
+                columns = (columns,) if isinstance(columns, str) else tuple(columns)
+                for c in columns:
+                    if c not in mappings:
+                        raise RuntimeError('Index column not found: %s' % c)
+                indexes.append(dict(name=_index_name(tableName, columns, unique), columns=columns, unique=unique))
+        attrs['__indexes__'] = indexes
+        attrs.pop('__unique__', None)
+        model = type.__new__(cls, name, bases, attrs)
+        model.__row__.__model__ = model
+        _models[name] = model
+        return model
 
 
 # Model从dict继承，所以具备所有dict的功能，同时又实现了特殊方法__getattr__()和__setattr__()，因此又可以像引用普通字段那样写
 # user['id'] => 123
 # user.id => 123
 class Model(dict, metaclass=ModelMetaclass):
+    # 按列投影或延迟加载时没有从数据库取出的属性名，保存在实例上而不是dict里，不会被序列化
+    _unloaded = frozenset()
+    # 从数据库读出时的原始行，update()和它比较，只写改动过的列;新建的对象为None
+    _original = None
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
@@ -182,6 +1138,9 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in self._unloaded:
+                raise AttributeError(r"'%s' field '%s' is not loaded, call 'await obj.load()' first" %
+                                     (self.__class__.__name__, key))
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
@@ -203,72 +1162,422 @@ class Model(dict, metaclass=ModelMetaclass):
     # 然后，我们往Model类添加class方法，就可以让所有子类调用class方法
     # user = yield from User.find(1)
     @classmethod
-    async def find(cls, pk):
+    def _projection(cls, fields):
+        'return (select sql, unloaded field names) for the given field subset'
+        if fields is None:
+            return cls.__select_eager__, cls.__deferred__
+        for f in fields:
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid field: %s' % f)
+        # 按类里定义的顺序选列，findRows()按同样的顺序从tuple取值
+        fields = [f for f in cls.__fields__ if f in fields]
+        sql = 'select `%s`, %s from `%s`' % (
+            cls.__primary_key__, ', '.join('`%s`' % f for f in fields), cls.__table__)
+        return sql, frozenset(cls.__fields__) - frozenset(fields)
+
+    @classmethod
+    def _loaded(cls, row, unloaded=None):
+        obj = cls(**row)
+        object.__setattr__(obj, '_original', row)
+        if unloaded:
+            object.__setattr__(obj, '_unloaded', unloaded)
+        return obj
+
+    @classmethod
+    async def find(cls, pk, fields=None):
         ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
+        if fields is not None:
+            sql, unloaded = cls._projection(fields)
+            rs = await select('%s where `%s`=?' % (sql, cls.__primary_key__), [pk], 1)
+            if len(rs) == 0:
+                return None
+            return cls._loaded(rs[0], unloaded)
+        loader = request_loader.get()
+        if loader is not None and not in_transaction():
+            row = await loader.load(cls, pk)
+        else:
+            row = (await cls._findRows([pk])).get(pk)
+        if row is None:
             return None
         # => Model(self,**{'id':1, 'name':'Test'})  =>  返回一个Model对象，**args是这个**dict
-        return cls(**rs[0])
+        return cls._loaded(row)
+
+    @classmethod
+    async def _findRows(cls, pks):
+        'return {pk: row} for the given primary keys, going through the cache if enabled'
+        rows = dict()
+        cache = None if in_transaction() else cls.__cache__
+        if cache is not None:
+            version = cache.version
+            for pk in pks:
+                row = cache.get(pk)
+                if row is not None:
+                    rows[pk] = row
+            pks = [pk for pk in pks if pk not in rows]
+        if not pks:
+            return rows
+        # 要写入缓存的行从主库读
+        primary = cache is not None
+        if len(pks) == 1:
+            rs = await select(cls.__find__, pks, 1, primary=primary)
+        else:
+            rs = await select('%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, ', '.join(['?'] * len(pks))),
+                              pks, primary=primary)
+        for r in rs:
+            pk = r[cls.__primary_key__]
+            rows[pk] = r
+            if cache is not None:
+                cache.put(pk, r, version)
+        return rows
+
+    @classmethod
+    def cache_stats(cls):
+        'hit/miss counters of the primary key cache, None if caching is off'
+        if cls.__cache__ is None:
+            return None
+        return cls.__cache__.stats()
+
+    def invalidate(self):
+        self._invalidatePk(self.getValue(self.__primary_key__))
+
+    @classmethod
+    def _countChanged(cls, delta):
+        if cls.__counts__ is not None:
+            cls.__counts__.add(delta)
+        cls._touch()
+
+    @classmethod
+    def _touch(cls):
+        tx = _transaction.get()
+        if tx is not None:
+            tx.touched.add(cls)
+
+    @classmethod
+    def _forgetAll(cls):
+        'drop every cached row and count of this model'
+        if cls.__cache__ is not None:
+            cls.__cache__.invalidate()
+        if cls.__counts__ is not None:
+            cls.__counts__.clear()
+
+    @classmethod
+    def _invalidatePk(cls, pk):
+        # pk为None时ModelCache.invalidate()会清空整个缓存
+        if pk is None:
+            return
+        if cls.__cache__ is not None:
+            cls.__cache__.invalidate(pk)
+        loader = request_loader.get()
+        if loader is not None:
+            loader.forget(cls, pk)
 
     # 根据WHERE条件查找
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
-        'find objects by where clause'
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
+        'find objects by where clause, deferred fields are left out unless listed in fields'
+        sql, args, unloaded = cls._findAllSql(where, args, **kw)
+        rs = await select(sql, args)
+        objs = [cls._loaded(r, unloaded) for r in rs]
+        prefetch = kw.get('prefetch', None)
+        if prefetch:
+            await cls.prefetch(objs, prefetch)
+        return objs
+
+    @classmethod
+    async def prefetch(cls, objs, names):
+        'load the named __relations__ for all objs, one query per relation, and set them as attributes'
+        relations = []
+        for name in names:
+            if name not in cls.__relations__:
+                raise ValueError('Invalid relation: %s' % name)
+            relations.append((name, cls.__relations__[name]))
+        pks = list(collections.OrderedDict.fromkeys(obj[cls.__primary_key__] for obj in objs))
+        if not pks:
+            return objs
+        results = await asyncio.gather(*[rel.fetch(pks) for name, rel in relations])
+        for (name, rel), values in zip(relations, results):
+            for obj in objs:
+                obj[name] = values.get(obj[cls.__primary_key__], rel.empty())
+        return objs
+
+    # 与findAll()参数相同，返回__row__类型的紧凑行对象
+    @classmethod
+    async def findRows(cls, where=None, args=None, **kw):
+        'find compact rows by where clause'
+        sql, args, unloaded = cls._findAllSql(where, args, **kw)
+        columns = tuple(c for c in cls.__row__.__slots__ if c not in unloaded)
+        make = _row_maker(cls.__row__, columns)
+        rs = await select(sql, args, tuples=True)
+        return [make(t) for t in rs]
+
+    # async for blog in Blog.iterate(orderBy='created_at desc'):
+    # 与findAll()参数相同，但是通过服务端游标每次读取batch行，适合遍历整张表
+    @classmethod
+    async def iterate(cls, where=None, args=None, batch=100, **kw):
+        'iterate objects by where clause, fetching batch rows at a time'
+        sql, args, unloaded = cls._findAllSql(where, args, **kw)
+        rows = iterselect(sql, args, batch)
+        try:
+            async for rs in rows:
+                for r in rs:
+                    yield cls._loaded(r, unloaded)
+        finally:
+            await rows.aclose()
+
+    @classmethod
+    def _findAllSql(cls, where=None, args=None, **kw):
+        fields = kw.get('fields', None)
+        after = kw.get('after', None)
         orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
-        limit = kw.get('limit')
+        limit = kw.get('limit', None)
+        args = list(args) if args else []
+        # keyset分页: after=(created_at, id)，只取排在该行之后的记录，不需要MySQL扫描再丢弃offset行
+        if after is not None:
+            args.extend([after[0], after[0], after[1]])
         if limit is not None:
-            sql.append('limit')
             if isinstance(limit, int):
-                sql.append('?')
                 args.append(limit)
             elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        key = ('findAll', where, orderBy, None if limit is None else isinstance(limit, int),
+               after is not None, None if fields is None else tuple(fields))
+        entry = cls.__statements__.get(key)
+        if entry is None:
+            _check_scan(cls, where, orderBy, limit is not None)
+            entry = cls._cacheStatement(key, *cls._buildFindAllSql(where, orderBy, limit, after, fields))
+        sql, unloaded = entry
+        return sql, args, unloaded
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
-        'find number by select and where'
-        
-        sql = ['select count(%s) as _num_ from `%s`' % (selectField, cls.__table__)]
+    def _buildFindAllSql(cls, where, orderBy, limit, after, fields):
+        select_sql, unloaded = cls._projection(fields)
+        sql = [select_sql]
+        if after is not None:
+            # 游标条件按(created_at desc, 主键 desc)写死，其他排序会跳过或重复行
+            if orderBy and _normalize_order(orderBy) != ('created_at desc', '%s desc' % cls.__primary_key__):
+                raise ValueError('after requires orderBy created_at desc, %s desc, got: %s' % (cls.__primary_key__, orderBy))
+            seek = '(`created_at` < ? or (`created_at` = ? and `%s` < ?))' % cls.__primary_key__
+            where = '(%s) and %s' % (where, seek) if where else seek
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        if after is not None and not orderBy:
+            orderBy = '`created_at` desc, `%s` desc' % cls.__primary_key__
+        if orderBy:
+            sql.append('order by')
+            sql.append(orderBy)
+        if limit is not None:
+            sql.append('limit')
+            sql.append('?' if isinstance(limit, int) else '?, ?')
+        return ' '.join(sql).replace('?', '%s'), unloaded
+
+    @classmethod
+    def _cacheStatement(cls, key, *entry):
+        if len(cls.__statements__) >= _MAX_STATEMENTS:
+            cls.__statements__.clear()
+        cls.__statements__[key] = entry
+        return entry
+
+    @classmethod
+    async def findNumber(cls, selectField, where=None, args=None):
+        'find number by select and where'
+        counts = cls.__counts__
+        if counts is None:
+            return await cls._countRows(selectField, where, args)
+        ckey = (selectField, where, tuple(args or ()))
+        n = counts.get(ckey)
+        if n is not None:
+            return n
+        version = counts.version
+        if counts.approximate and not where:
+            n = await cls._approximateRows()
+        else:
+            n = await cls._countRows(selectField, where, args, primary=True)
+        if n is not None:
+            # count(列)不计NULL，只有count(主键)和count(*)能随插入删除直接增减
+            counts.put(ckey, n, not where and selectField in ('*', cls.__primary_key__), version)
+        return n
+
+    @classmethod
+    def reconcileCounts(cls):
+        'drop cached counts so the next findNumber() re-reads them'
+        if cls.__counts__ is not None:
+            cls.__counts__.clear()
+
+    @classmethod
+    async def _approximateRows(cls):
+        rs = await select('select `table_rows` as _num_ from information_schema.tables '
+                          'where `table_schema`=database() and `table_name`=?', [cls.__table__], 1, primary=True)
+        if len(rs) == 0:
+            return None
+        return int(rs[0]['_num_'])
+
+    @classmethod
+    async def _countRows(cls, selectField, where=None, args=None, primary=False):
+        key = ('findNumber', selectField, where)
+        entry = cls.__statements__.get(key)
+        if entry is None:
+            if where:
+                _check_scan(cls, where, None, False)
+            sql = ['select count(%s) as _num_ from `%s`' % (selectField, cls.__table__)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            entry = cls._cacheStatement(key, ' '.join(sql).replace('?', '%s'))
+        rs = await select(entry[0], args, 1, primary=primary)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
 
     async def save(self):
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        # logging.info(args)
-        args.append(self.getValueOrDefault(self.__primary_key__))
+        args = self.__insert_args__(self)
         rows = await execute(self.__insert__, args)
+        self.invalidate()
+        self._countChanged(rows)
         if rows != 1:
             logging.warn('failed to insert record: affected rows %s' % rows)
 
+    # 批量插入: 每chunk行拼成一条多行INSERT，只占用一次连接和一次往返
+    @classmethod
+    async def save_many(cls, objs, chunk=500):
+        'insert objects with multi-row INSERT statements, return affected rows of each chunk'
+        counts = await cls._insertChunks(objs, chunk)
+        for i, rows in enumerate(counts):
+            if rows != len(objs[i * chunk:(i + 1) * chunk]):
+                logging.warn('failed to insert records: affected rows %s of %s' % (rows, len(objs[i * chunk:(i + 1) * chunk])))
+        cls._countChanged(sum(counts))
+        return counts
+
+    @classmethod
+    async def _insertChunks(cls, objs, chunk, suffix=''):
+        counts = []
+        insert_args = cls.__insert_args__
+        for i in range(0, len(objs), chunk):
+            part = objs[i:i + chunk]
+            args = []
+            for obj in part:
+                args.extend(insert_args(obj))
+            sql = cls.__insert__
+            if len(part) > 1:
+                sql = '%s, %s' % (sql, ', '.join([cls.__insert_row__] * (len(part) - 1)))
+            counts.append(await execute(sql + suffix, args))
+        for obj in objs:
+            cls._invalidatePk(obj.getValue(cls.__primary_key__))
+        return counts
+
+    # upsert: INSERT ... ON DUPLICATE KEY UPDATE，一次往返完成"不存在就插入，存在就更新";
+    # update为要更新的列名列表(默认全部非主键列，取插入的值)，或者{列名: SQL表达式}，
+    # 例如计数器: update={'count': '`count` + values(`count`)'}
+    @classmethod
+    def _upsertClause(cls, update=None):
+        if update is None:
+            update = cls.__fields__
+        if not update:
+            raise ValueError('upsert needs at least one column to update')
+        key = ('upsert', tuple(sorted(update.items())) if isinstance(update, dict) else tuple(update))
+        entry = cls.__statements__.get(key)
+        if entry is None:
+            items = update.items() if isinstance(update, dict) else [(f, 'values(`%s`)' % f) for f in update]
+            sets = []
+            for f, expr in items:
+                if f not in cls.__mappings__:
+                    raise ValueError('Invalid field: %s' % f)
+                sets.append('`%s`=%s' % (f, expr))
+            entry = cls._cacheStatement(key, ' on duplicate key update %s' % ', '.join(sets))
+        return entry[0]
+
+    async def upsert(self, update=None):
+        'insert, or update the given columns if the primary or a unique key exists; returns MySQL affected rows (1 insert, 2 update, 0 unchanged)'
+        rows = await execute(self.__insert__ + self._upsertClause(update), self.__insert_args__(self))
+        self.invalidate()
+        self._upserted(rows > 1)
+        self._countChanged(1 if rows == 1 else 0)
+        return rows
+
+    @classmethod
+    def _upserted(cls, updated):
+        # 冲突发生在唯一索引上时，被更新的是另一个主键的行，只能整体丢弃行缓存
+        if updated and cls.__cache__ is not None and any(index['unique'] for index in cls.__indexes__):
+            cls.__cache__.invalidate()
+
+    @classmethod
+    async def upsert_many(cls, objs, update=None, chunk=500):
+        'upsert objects with multi-row statements, return affected rows of each chunk'
+        counts = await cls._insertChunks(objs, chunk, cls._upsertClause(update))
+        # 未改变的行计0、更新的行计2，总数看不出有没有行被更新，只能按有更新处理
+        cls._upserted(True)
+        # 影响行数分不出插入和更新各有多少，计数缓存只能整体丢弃
+        if cls.__counts__ is not None:
+            cls.__counts__.clear()
+        cls._touch()
+        return counts
+
+    async def load(self, *names):
+        'load deferred or unprojected fields, all of them if no names given'
+        names = [n for n in (names or self._unloaded) if n not in self]
+        if names:
+            sql, _ = self._projection(names)
+            rs = await select('%s where `%s`=?' % (sql, self.__primary_key__), [self.getValue(self.__primary_key__)], 1)
+            if len(rs) == 0:
+                raise ValueError('Record not found: %s' % self.getValue(self.__primary_key__))
+            for n in names:
+                self[n] = rs[0][n]
+            if self._original is not None:
+                object.__setattr__(self, '_original', dict(self._original, **rs[0]))
+        object.__setattr__(self, '_unloaded', self._unloaded - frozenset(names))
+        return self
+
+    def dirtyFields(self):
+        'fields changed since the object was loaded, every loaded field for objects not read from the database'
+        original = self._original
+        if original is None:
+            # 没有加载的列不能写回，否则会被覆盖成默认值
+            return [f for f in self.__fields__ if f in self or f not in self._unloaded]
+        return [f for f in self.__fields__ if f in self and (f not in original or self[f] != original[f])]
+
     async def update(self):
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        fields = self.dirtyFields()
+        if not fields:
+            logging.debug('skip update of unchanged record: %s' % self.getValue(self.__primary_key__))
+            return
+        if len(fields) == len(self.__fields__):
+            sql = self.__update__
+            args = self.__update_args__(self)
+        else:
+            key = ('update', tuple(fields))
+            entry = self.__statements__.get(key)
+            if entry is None:
+                entry = self._cacheStatement(key, 'update `%s` set %s where `%s`=%%s' % (
+                    self.__table__, ', '.join('`%s`=%%s' % (self.__mappings__[f].name or f) for f in fields),
+                    self.__primary_key__))
+            sql = entry[0]
+            args = list(map(self.getValueOrDefault, fields))
+            args.append(self.getValue(self.__primary_key__))
+        rows = await execute(sql, args)
+        self.invalidate()
+        self._countChanged(0)
         if rows != 1:
             logging.warn('failed to update record: affected rows %s' % rows)
+        if self._original is not None:
+            object.__setattr__(self, '_original', dict(self))
+
+    @classmethod
+    async def removeAll(cls, where, args=None):
+        'delete rows by where clause, return affected rows'
+        rows = await execute('delete from `%s` where %s' % (cls.__table__, where), args)
+        cls._forgetAll()
+        cls._touch()
+        loader = request_loader.get()
+        if loader is not None:
+            loader.forgetAll(cls)
+        return rows
 
     async def remove(self):
         args = self.getValue(self.__primary_key__)
         rows = await execute(self.__delete__, args)
+        self.invalidate()
+        self._countChanged(-rows)
         if rows != 1:
             logging.warn('failed to delete record: affected rows %s' % rows)
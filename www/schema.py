@@ -0,0 +1,126 @@
+#!/bin/bash env python3
+# -*- coding: utf-8 -*-
+
+'''
+Schema management derived from the models.
+
+Usage: python3 schema.py ddl|diff|apply|scans
+
+    ddl     print CREATE TABLE statements for all models
+    diff    compare declared indexes with information_schema and print the missing ones
+    apply   create missing tables and add missing indexes
+    scans   EXPLAIN the query shapes in QUERIES and print the ones that scan a whole table or filesort
+'''
+
+import asyncio
+import logging
+import sys
+import orm
+from config import configs
+from models import User, Blog, Comment
+
+# _check_scan()的警告由scans命令统一输出
+logging.getLogger().setLevel(logging.ERROR)
+
+MODELS = (User, Blog, Comment)
+
+# handlers里用到的findAll()/findRows()查询形式: (Model, where, args, findAll的关键字参数);
+# 参数值只用于让EXPLAIN能执行，不影响执行计划里用不用索引
+_ORDER_BY_LATEST = 'created_at desc, id desc'
+QUERIES = (
+    (Blog, None, None, dict(orderBy=_ORDER_BY_LATEST, limit=(0, 10))),
+    (Blog, None, None, dict(orderBy=_ORDER_BY_LATEST, limit=11, after=(0.0, ''))),
+    (Comment, None, None, dict(orderBy=_ORDER_BY_LATEST, limit=(0, 10))),
+    (Comment, '`blog_id`=?', [''], dict(orderBy='created_at desc')),
+    (User, None, None, dict(orderBy=_ORDER_BY_LATEST, limit=(0, 10))),
+    (User, 'email=?', [''], dict()),
+)
+
+
+async def existing_indexes(cls):
+    '''
+    Return None if the table does not exist, else the column tuples of its indexes.
+    '''
+    rs = await orm.select('select `index_name`, `column_name` from information_schema.statistics '
+                          'where `table_schema`=database() and `table_name`=? order by `index_name`, `seq_in_index`',
+                          [cls.__table__])
+    if not rs:
+        tables = await orm.select('select `table_name` from information_schema.tables '
+                                  'where `table_schema`=database() and `table_name`=?', [cls.__table__])
+        if not tables:
+            return None
+    indexes = dict()
+    for r in rs:
+        indexes.setdefault(r['index_name'], []).append(r['column_name'])
+    return set(tuple(columns) for columns in indexes.values())
+
+
+async def missing(cls):
+    '''
+    Return (create table sql or None, [add index sql]) needed to match the model.
+    '''
+    existing = await existing_indexes(cls)
+    if existing is None:
+        return orm.create_table_sql(cls), []
+    return None, [orm.add_index_sql(cls, index) for index in cls.__indexes__ if index['columns'] not in existing]
+
+
+def ddl():
+    for cls in MODELS:
+        print('%s;\n' % orm.create_table_sql(cls))
+
+
+async def diff(apply=False):
+    for cls in MODELS:
+        create, alters = await missing(cls)
+        for sql in ([create] if create else []) + alters:
+            print('%s;' % sql)
+            if apply:
+                await orm.execute(sql, None)
+        if not create and not alters:
+            print('-- %s: up to date' % cls.__table__)
+
+
+async def explain(cls, where, args, kw):
+    '''
+    Return the EXPLAIN rows of a findAll() query that scan a whole table or sort without an index.
+    '''
+    sql, args, _ = cls._findAllSql(where, args, **kw)
+    rs = await orm.select('explain %s' % sql, args)
+    return [r for r in rs if r.get('type') == 'ALL' or 'filesort' in (r.get('Extra') or '')]
+
+
+async def scans():
+    found = False
+    for cls, where, args, kw in QUERIES:
+        for r in await explain(cls, where, args, kw):
+            found = True
+            print('%s: where=%s, %s -> type=%s, key=%s, rows=%s, extra=%s' % (
+                cls.__table__, where, kw, r.get('type'), r.get('key'), r.get('rows'), r.get('Extra')))
+    # 生成SQL时按声明的索引做的静态检查
+    for scan in orm.full_scans():
+        found = True
+        print('%(table)s: where=%(where)s, orderBy=%(orderBy)s -> %(reason)s' % scan)
+    if not found:
+        print('-- no full scans')
+
+
+async def main(loop, command):
+    await orm.create_pool(loop=loop, **configs.db)
+    if command == 'scans':
+        await scans()
+    else:
+        await diff(apply=(command == 'apply'))
+    await orm.close_pool()
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in ('ddl', 'diff', 'apply', 'scans'):
+        print(__doc__)
+        exit(0)
+    if argv[0] == 'ddl':
+        ddl()
+    else:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(main(loop, argv[0]))
@@ -0,0 +1,143 @@
+#!/bin/bash env python3
+# -*- coding: utf-8 -*-
+
+'''
+JSON encoding of API responses, using orjson when it is installed.
+'''
+
+import json
+import logging
+import orm
+from apis import Page
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 每个类型一个编码函数，把对象转换为可以直接序列化的dict;
+# Model和Row的编码函数在第一次用到时按__mappings__生成，只输出字段和已加载的关联，去掉__private__里的字段
+_encoders = {}
+
+
+def _model_encoder(cls):
+    '''
+    Generate encode(obj) returning a plain dict of the public fields of a cls instance.
+    '''
+    fields = [f for f in [cls.__primary_key__] + cls.__fields__ if f not in cls.__private__]
+    lines = ['def encode(o):',
+             '    try:',
+             '        d = {%s}' % ', '.join('%r: o[%r]' % (f, f) for f in fields),
+             '    except KeyError:',
+             # 只查询了部分字段(fields=或延迟加载)的对象
+             '        d = {k: o[k] for k in fields if k in o}']
+    for name in cls.__relations__:
+        lines.append('    if %r in o:' % name)
+        lines.append('        d[%r] = o[%r]' % (name, name))
+    lines.append('    return d')
+    ns = dict(fields=fields)
+    exec('\n'.join(lines), ns)
+    return ns['encode']
+
+
+def _row_encoder(row_cls):
+    private = row_cls.__model__.__private__
+    fields = tuple(f for f in row_cls.__slots__ if f not in private)
+
+    def encode(o):
+        d = {}
+        for f in fields:
+            try:
+                d[f] = getattr(o, f)
+            except AttributeError:
+                pass
+        return d
+    return encode
+
+
+def _encode_page(p):
+    return dict(item_count=p.item_count, page_count=p.page_count, page_index=p.page_index, page_size=p.page_size,
+                offset=p.offset, limit=p.limit, has_next=p.has_next, has_previous=p.has_previous,
+                next_cursor=p.next_cursor)
+
+
+_encoders[Page] = _encode_page
+
+
+def register(cls, fn):
+    'encode cls instances with fn(obj), which returns something serializable'
+    _encoders[cls] = fn
+
+
+def _encoder(cls):
+    fn = _encoders.get(cls)
+    if fn is None:
+        if issubclass(cls, orm.Model):
+            fn = _model_encoder(cls)
+        elif issubclass(cls, orm.Row):
+            fn = _row_encoder(cls)
+        else:
+            return None
+        _encoders[cls] = fn
+    return fn
+
+
+def default(o):
+    fn = _encoder(type(o))
+    if fn is not None:
+        return fn(o)
+    # 其他对象沿用原来的做法
+    try:
+        return o.__dict__
+    except AttributeError:
+        raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+
+def _plain(o):
+    # 标准库json把dict的子类直接当dict输出，不会调用default，所以先把Model换成编码后的dict
+    t = type(o)
+    if t is dict:
+        return {k: _plain(v) for k, v in o.items()}
+    if t is list or t is tuple:
+        return [_plain(v) for v in o]
+    if isinstance(o, orm.Model):
+        d = _encoder(t)(o)
+        # 字段值都是数据库里的基本类型，只有关联可能还包含Model
+        for name in t.__relations__:
+            if name in d:
+                d[name] = _plain(d[name])
+        return d
+    return o
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(_plain(obj), ensure_ascii=False, default=default).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    # OPT_PASSTHROUGH_SUBCLASS: Model是dict的子类，交给default()按字段编码
+    return orjson.dumps(obj, default=default, option=orjson.OPT_PASSTHROUGH_SUBCLASS)
+
+
+_BACKENDS = dict(stdlib=_stdlib_dumps)
+if orjson is not None:
+    _BACKENDS['orjson'] = _orjson_dumps
+
+backend = None
+dumps = None
+
+
+def use(name='auto'):
+    '''
+    Select the JSON backend: 'orjson', 'stdlib' or 'auto' (orjson if installed).
+    '''
+    global backend, dumps
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in _BACKENDS else 'stdlib'
+    if name not in _BACKENDS:
+        raise ValueError('JSON backend not available: %s' % name)
+    backend, dumps = name, _BACKENDS[name]
+    logging.info('use JSON backend: %s' % name)
+
+
+use()
@@ -0,0 +1,312 @@
+#!/bin/bash env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests for orm internals that need no database: run with python3 -m unittest test_orm
+'''
+
+import asyncio
+import collections
+import unittest
+import orm
+from models import User, Blog, Comment
+
+
+class SelectCoalescingTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.calls = []
+        self._select, self._coalesce = orm._select, orm._coalesce
+
+        async def fake_select(sql, args, size=None, tuples=False, primary=False):
+            self.calls.append(sql)
+            await asyncio.sleep(0.01)
+            return [dict(id='a')]
+        orm._select = fake_select
+        orm._coalesce = True
+
+    def tearDown(self):
+        orm._select, orm._coalesce = self._select, self._coalesce
+
+    async def test_leader_cancel_does_not_fail_followers(self):
+        leader = asyncio.ensure_future(orm.select('select 1', []))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(orm.select('select 1', []))
+        await asyncio.sleep(0)
+        leader.cancel()
+        self.assertEqual(await follower, [dict(id='a')])
+        self.assertEqual(len(self.calls), 1)
+
+    async def test_request_that_wrote_does_not_join(self):
+        other = asyncio.ensure_future(orm.select('select 1', []))
+        await asyncio.sleep(0)
+        with orm.request_scope():
+            orm._mark_write()
+            await orm.select('select 1', [])
+        await other
+        self.assertEqual(len(self.calls), 2)
+
+
+class LoaderTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self._findRows = orm.Model._findRows.__func__
+        self.error = None
+
+        async def find_rows(cls, pks):
+            await asyncio.sleep(0.01)
+            if self.error is not None:
+                raise self.error
+            return {pk: cls(id=pk) for pk in pks}
+        orm.Model._findRows = classmethod(find_rows)
+
+    def tearDown(self):
+        orm.Model._findRows = classmethod(self._findRows)
+
+    async def test_forget_while_loading(self):
+        loader = orm.Loader()
+        find = asyncio.ensure_future(loader.load(Blog, 'a'))
+        await asyncio.sleep(0.001)
+        loader.forget(Blog, 'a')
+        blog = await asyncio.wait_for(find, 1)
+        self.assertEqual(blog.id, 'a')
+
+    async def test_error_goes_to_callers(self):
+        self.error = RuntimeError('db down')
+        loader = orm.Loader()
+        with self.assertRaises(RuntimeError):
+            await asyncio.wait_for(loader.load(Blog, 'a'), 1)
+
+
+class TransactionCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_commit_drops_rows_cached_during_transaction(self):
+        class Conn(object):
+            async def commit(self):
+                pass
+        tx = orm.Transaction()
+        tx.conn, tx.lock = Conn(), asyncio.Lock()
+        tx.touched.add(Blog)
+        # 事务提交前其他请求读到并缓存的旧数据
+        Blog.__cache__.put('a', dict(id='a', name='old'))
+        await tx.commit()
+        self.assertIsNone(Blog.__cache__.get('a'))
+
+
+class DuplicateKeyTest(unittest.TestCase):
+
+    def test_is_duplicate(self):
+        self.assertTrue(orm.is_duplicate(orm.aiomysql.IntegrityError(1062, "Duplicate entry 'a' for key 'email'")))
+        self.assertFalse(orm.is_duplicate(orm.aiomysql.IntegrityError(1452, 'Cannot add a child row')))
+        self.assertFalse(orm.is_duplicate(ValueError(1062)))
+
+
+class PingIdleTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_pings_every_idle_connection_one_at_a_time(self):
+        pinged = []
+
+        class Conn(object):
+            closed = False
+
+            async def ping(self, reconnect=True):
+                pinged.append(self)
+                self.free_during_ping = len(pool._free)
+
+        class Pool(object):
+            def __init__(self, n):
+                self._free = collections.deque(Conn() for _ in range(n))
+
+            @property
+            def freesize(self):
+                return len(self._free)
+
+            async def acquire(self):
+                return self._free.popleft()
+
+            def release(self, conn):
+                self._free.append(conn)
+
+        pool = Pool(6)
+        await orm.ping_idle(pool)
+        self.assertEqual(len(set(pinged)), 6)
+        self.assertTrue(all(c.free_during_ping == 5 for c in pinged))
+
+
+class Conn(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Pool(object):
+    '''
+    The parts of aiomysql.Pool that the orm touches: waiters block on _cond until a release wakes them.
+    '''
+
+    def __init__(self, maxsize):
+        self._cond = asyncio.Condition()
+        self._free = collections.deque(maxlen=maxsize)
+        self._used = set()
+        self._minsize = 0
+
+    size = property(lambda self: len(self._free) + len(self._used))
+    freesize = property(lambda self: len(self._free))
+    maxsize = property(lambda self: self._free.maxlen)
+    minsize = property(lambda self: self._minsize)
+
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                if self._free:
+                    conn = self._free.popleft()
+                elif self.size < self.maxsize:
+                    conn = Conn()
+                else:
+                    await self._cond.wait()
+                    continue
+                self._used.add(conn)
+                return conn
+
+    def release(self, conn):
+        self._used.remove(conn)
+        # 与aiomysql相同: 关闭的连接不放回，也不唤醒等待者
+        if not conn.closed:
+            self._free.append(conn)
+            asyncio.ensure_future(self._wakeup())
+
+    async def _wakeup(self):
+        async with self._cond:
+            self._cond.notify()
+
+
+class PoolWakeupTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.pool = Pool(1)
+        orm._pool_stats[self.pool] = orm.PoolStats('test', self.pool)
+
+    def tearDown(self):
+        del orm._pool_stats[self.pool]
+
+    async def test_grow_wakes_waiters(self):
+        await self.pool.acquire()
+        waiter = asyncio.ensure_future(self.pool.acquire())
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiter.done())
+        orm.resize_pool(self.pool, maxsize=2)
+        await asyncio.wait_for(waiter, 1)
+
+    async def test_release_of_closed_connection_wakes_waiters(self):
+        # iterselect()提前停止时关闭连接，再由_Checkout放回连接池
+        checkout = orm._Checkout(self.pool)
+        conn = await checkout.acquire()
+        waiter = asyncio.ensure_future(self.pool.acquire())
+        await asyncio.sleep(0.01)
+        conn.close()
+        checkout.release()
+        await asyncio.wait_for(waiter, 1)
+
+
+class CacheFillReadsPrimaryTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.primary = []
+        self._select = orm._select
+
+        async def fake_select(sql, args, size=None, tuples=False, primary=False):
+            self.primary.append(primary)
+            return [dict(id=args[0], _num_=1)] if args else [dict(_num_=1)]
+        orm._select = fake_select
+        Blog.__cache__.invalidate()
+        Blog.__counts__.clear()
+
+    def tearDown(self):
+        orm._select = self._select
+
+    async def test_cached_models_read_primary(self):
+        await Blog._findRows(['a'])
+        await Blog.findNumber('id')
+        self.assertEqual(self.primary, [True, True])
+
+    async def test_uncached_models_may_read_replicas(self):
+        await Comment._findRows(['a'])
+        self.assertEqual(self.primary, [False])
+
+
+class CountCacheTest(unittest.TestCase):
+
+    def test_zero_reconcile_never_expires(self):
+        for reconcile in (0, None):
+            counts = orm.CountCache(reconcile=reconcile)
+            counts.put('all', 3, True)
+            self.assertEqual(counts.get('all'), 3)
+
+
+class UpsertTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self._execute = orm.execute
+
+        async def fake_execute(sql, args):
+            # 一行更新(2)加一行未改变(0)
+            return 2
+        orm.execute = fake_execute
+
+    def tearDown(self):
+        orm.execute = self._execute
+
+    def test_empty_update_rejected(self):
+        for update in ([], {}):
+            with self.assertRaises(ValueError):
+                Blog._upsertClause(update)
+
+    async def test_upsert_many_flushes_cache_for_unique_keys(self):
+        User.__cache__.put('other', dict(id='other', email='a@example.com'))
+        await User.upsert_many([User(id='x', email='a@example.com'), User(id='y', email='b@example.com')])
+        self.assertIsNone(User.__cache__.get('other'))
+
+
+class SaveInvalidateTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self._execute = orm.execute
+
+        async def fake_execute(sql, args):
+            return 1
+        orm.execute = fake_execute
+        Blog.__cache__.invalidate()
+        Blog.__cache__.put('a', dict(id='a'))
+        Blog.__cache__.put('b', dict(id='b'))
+
+    def tearDown(self):
+        orm.execute = self._execute
+
+    async def test_save_keeps_other_cached_rows(self):
+        blog = Blog(user_id='u', name='n', summary='s', content='c')
+        await blog.save()
+        self.assertIn('id', blog)
+        self.assertEqual(Blog.__cache__.stats()['size'], 2)
+
+    async def test_save_many_keeps_other_cached_rows(self):
+        blogs = [Blog(user_id='u', name='n', summary='s', content='c') for _ in range(3)]
+        await Blog.save_many(blogs)
+        self.assertTrue(all('id' in b for b in blogs))
+        self.assertEqual(Blog.__cache__.stats()['size'], 2)
+
+
+class KeysetOrderTest(unittest.TestCase):
+
+    def test_after_accepts_only_keyset_order(self):
+        for orderBy in (None, 'created_at desc, id desc', '`created_at` DESC,  `id` desc'):
+            Blog._buildFindAllSql(None, orderBy, 10, (0.0, ''), None)
+        for orderBy in ('created_at desc', 'created_at asc, id asc', 'name desc, id desc'):
+            with self.assertRaises(ValueError):
+                Blog._buildFindAllSql(None, orderBy, 10, (0.0, ''), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/bin/bash env python3
+# -*- coding: utf-8 -*-
+
+'''
+Request-scoped tracing spans written as Chrome trace JSON.
+'''
+
+import contextvars
+import itertools
+import json
+import os
+import time
+
+# 请求级追踪: 中间件对抽样到的请求调用start()，之后同一个请求里(包括它创建的task)的
+# with span('select', sql=...)都通过contextvars记到这个Trace上，父子关系由_parent传递;
+# 没有在追踪的请求里span()只做一次contextvar读取;
+# Trace.dump()写出Chrome trace格式(chrome://tracing、Perfetto可以直接打开)
+_trace = contextvars.ContextVar('trace', default=None)
+_parent = contextvars.ContextVar('span_parent', default=0)
+_ids = itertools.count(1)
+
+
+class Trace(object):
+    '''
+    The spans recorded for one request.
+    '''
+
+    def __init__(self, name):
+        self.id = next(_ids)
+        self.name = name
+        self.events = []
+        self._span_ids = itertools.count(1)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit='ms'), f, ensure_ascii=False, default=str)
+
+
+class span(object):
+    '''
+    Context manager recording a complete ("X") event on the current trace, if any.
+    '''
+
+    __slots__ = ('name', 'args', '_trace', '_id', '_token', '_start')
+
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+        self._trace = None
+
+    def __enter__(self):
+        trace = self._trace = _trace.get()
+        if trace is not None:
+            self._id = next(trace._span_ids)
+            self.args['parent'] = _parent.get()
+            self._token = _parent.set(self._id)
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self._trace
+        if trace is None:
+            return
+        end = time.perf_counter()
+        _parent.reset(self._token)
+        self.args['id'] = self._id
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        trace.events.append(dict(name=self.name, ph='X', pid=os.getpid(), tid=trace.id,
+                                 ts=self._start * 1e6, dur=(end - self._start) * 1e6, args=self.args))
+
+
+def start(name):
+    '''
+    Start tracing the current context; returns the Trace and a token for finish().
+    '''
+    trace = Trace(name)
+    return trace, (_trace.set(trace), _parent.set(0))
+
+
+def finish(token):
+    trace_token, parent_token = token
+    _parent.reset(parent_token)
+    _trace.reset(trace_token)
+
+
+def current():
+    return _trace.get()